@@ -0,0 +1,289 @@
+import argparse
+import collections
+import logging
+import ctypes
+import multiprocessing
+import multiprocessing.sharedctypes
+import sys
+import timeit
+
+import board
+import book
+import engine
+import pgn
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# outcome of validating one game, moves is the number of moves that could be played,
+# fen the position reached and error None or the reason the replay stopped
+ValidationResult = collections.namedtuple('ValidationResult', 'offset moves fen error')
+
+# outcome of a parallel search, result is the SearchResult of the main worker,
+# nodes the nodes searched by all the workers and seconds the time of the main worker
+ParallelResult = collections.namedtuple('ParallelResult', 'result processes nodes seconds')
+
+# settings of the current worker process, set up by init_worker
+worker_backend = board.LIST_BACKEND
+worker_cache = None
+
+def init_worker(backend, cache_size):
+    global worker_backend, worker_cache
+    logging.getLogger().setLevel(logging.WARNING)
+    worker_backend = backend
+    worker_cache = board.PositionCache(cache_size) if cache_size else None
+
+def new_pool(processes, backend, cache_size):
+    return multiprocessing.Pool(processes, initializer=init_worker, initargs=(backend, cache_size))
+
+# workers receive FEN strings and SAN moves rather than pickled boards
+
+def validate_worker(task):
+    offset, headers, moves = task
+    result = pgn.replay_game(pgn.Game(offset, headers, moves, None), worker_backend, worker_cache, log_positions=False)
+    fen = result.board.to_fen() if result.board is not None else None
+    return ValidationResult(offset, len(result.moves), fen, result.error)
+
+def perft_worker(task):
+    fen, move, depth = task
+    b = board.Board.from_fen(fen, backend=worker_backend, cache=worker_cache)
+    b.push(move)
+    return move, b.perft(depth-1)
+
+# validates games (pgn.Game tuples, as yielded by pgn.read_games) across a process pool,
+# the results come back in the same order as the games
+def validate_games(games, processes=None, backend=board.LIST_BACKEND, cache_size=None, chunksize=16):
+    tasks = ( (game.offset, game.headers, game.moves) for game in games )
+    pool = new_pool(processes, backend, cache_size)
+    try:
+        for result in pool.imap(validate_worker, tasks, chunksize):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def validate_pgn(path, processes=None, backend=board.LIST_BACKEND, cache_size=None, chunksize=16):
+    with open(path, 'rb') as f:
+        for result in validate_games(pgn.read_games(f), processes, backend, cache_size, chunksize):
+            yield result
+
+# divide() with the root moves spread across a process pool, returns a dict of
+# (start, end) move to node count that is the same whatever the number of processes
+def parallel_divide(fen, depth, processes=None, backend=board.LIST_BACKEND, cache_size=None):
+    if depth < 1:
+        raise Exception, "Depth {} is not allowed".format(depth)
+
+    root = board.Board.from_fen(fen, backend=backend)
+    tasks = [ (fen, move, depth) for move in sorted(root.generate_legal_moves()) ]
+
+    pool = new_pool(processes, backend, cache_size)
+    try:
+        # one move per task so the big subtrees do not end up queued behind each other
+        counts = dict(pool.imap_unordered(perft_worker, tasks, 1))
+    finally:
+        pool.terminate()
+        pool.join()
+    return counts
+
+def parallel_perft(fen, depth, processes=None, backend=board.LIST_BACKEND, cache_size=None):
+    if depth == 0:
+        return 1
+    return sum(parallel_divide(fen, depth, processes, backend, cache_size).values())
+
+## PARALLEL SEARCH
+# lazy SMP: every worker searches the same root position with its own Engine and all of
+# them share the transposition table so each worker finds the results the others have
+# stored. The main worker goes through every depth while each helper skips depths in its
+# own pattern, which gets it ahead of the main worker at a different offset
+
+# the helpers skip the depths where (depth + phase) // size is odd, helper n using the
+# entry (n - 1) % len(SKIP_SIZES), the patterns come from the Stockfish lazy SMP
+SKIP_SIZES = (1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4)
+SKIP_PHASES = (0, 1, 0, 1, 2, 3, 0, 1, 2, 3, 4, 5, 0, 1, 2, 3, 4, 5, 6, 7)
+
+# the iteration depths of a worker, 0 being the main worker
+def worker_depths(worker, max_depth):
+    if worker == 0:
+        return range(1, max_depth+1)
+    size, phase = SKIP_SIZES[(worker-1) % len(SKIP_SIZES)], SKIP_PHASES[(worker-1) % len(SKIP_SIZES)]
+    return [ depth for depth in range(1, max_depth+1) if not ((depth + phase) // size) % 2 ]
+
+# bits of the table data word: move (12 bits as in book.encode_move), move present,
+# bound (2 bits), depth (8 bits) and score plus SCORE_OFFSET (18 bits)
+MOVE_PRESENT = 1 << 12
+BOUND_SHIFT, DEPTH_SHIFT, SCORE_SHIFT = 13, 15, 23
+SCORE_OFFSET = 1 << 17
+
+def encode_entry(depth, score, bound, move):
+    data = (score + SCORE_OFFSET) << SCORE_SHIFT | min(depth, 0xff) << DEPTH_SHIFT | bound << BOUND_SHIFT
+    if move is not None:
+        data |= MOVE_PRESENT | book.encode_move(move)
+    return data
+
+def decode_entry(key, data):
+    data = int(data)
+    move = book.decode_move(data & 0xfff) if data & MOVE_PRESENT else None
+    return (key, (data >> DEPTH_SHIFT) & 0xff, (data >> SCORE_SHIFT) - SCORE_OFFSET, (data >> BOUND_SHIFT) & 3, move)
+
+# transposition table in shared memory, two 64 bit words per entry: the key xor the data,
+# then the data. There is no lock, an entry torn by two workers writing it at once
+# no longer xors back to its key and is treated as a miss
+def new_shared_table(table_size):
+    if table_size & (table_size - 1):
+        raise Exception, "Table size {} is not a power of two".format(table_size)
+    return multiprocessing.sharedctypes.RawArray(ctypes.c_uint64, 2 * table_size)
+
+class SharedTableEngine(engine.Engine):
+    def __init__(self, table):
+        self.table_size = len(table) // 2
+        self.table = table
+        self.reset_stats()
+
+    def clear(self):
+        ctypes.memset(self.table, 0, ctypes.sizeof(self.table))
+        self.reset_stats()
+
+    def load(self, key):
+        i = 2 * (key & (self.table_size - 1))
+        check, data = self.table[i], self.table[i+1]
+        # depth is at least 1 in a stored entry so the data of an empty one is 0
+        if not data or check ^ data != key:
+            return None
+        return decode_entry(key, data)
+
+    def save(self, entry):
+        key = entry[0]
+        data = encode_entry(*entry[1:])
+        i = 2 * (key & (self.table_size - 1))
+        self.table[i] = key ^ data
+        self.table[i+1] = data
+
+# settings of the current search worker process, set up by init_search_worker
+worker_table = None
+worker_stop = None
+
+def init_search_worker(backend, table, stop):
+    global worker_table, worker_stop
+    init_worker(backend, None)
+    worker_table = table
+    worker_stop = stop
+
+# helpers search up to this depth unless the main worker is done before
+HELPER_MAX_DEPTH = 64
+
+def search_worker(task):
+    fen, worker, max_depth, time_limit, node_limit = task
+    b = board.Board.from_fen(fen, backend=worker_backend)
+    search_engine = SharedTableEngine(worker_table)
+    if worker == 0:
+        result = search_engine.search(b, max_depth, time_limit, node_limit)
+        # the helpers only stop when the main worker is done
+        worker_stop.set()
+    else:
+        result = search_engine.search(b, HELPER_MAX_DEPTH, time_limit, node_limit, stop=worker_stop.is_set,
+                                      depths=worker_depths(worker, HELPER_MAX_DEPTH))
+    return worker, result
+
+# searches the position with processes workers sharing a table of table_size entries,
+# max_depth, time_limit and node_limit are those of the main worker as in Engine.search
+def parallel_search(fen, processes=None, max_depth=64, time_limit=None, node_limit=None,
+                    backend=board.LIST_BACKEND, table_size=1 << 18):
+    processes = processes or multiprocessing.cpu_count()
+    table = new_shared_table(table_size)
+    stop = multiprocessing.Event()
+    tasks = [ (fen, worker, max_depth, time_limit, node_limit) for worker in range(processes) ]
+
+    pool = multiprocessing.Pool(processes, initializer=init_search_worker, initargs=(backend, table, stop))
+    try:
+        results = dict(pool.imap_unordered(search_worker, tasks, 1))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    main_result = results[0]
+    nodes = sum(result.nodes for result in results.values())
+    return ParallelResult(main_result, processes, nodes, main_result.seconds)
+
+def format_parallel_result(result):
+    nps = result.nodes / result.seconds if result.seconds else 0.0
+    return "{} processes: {}, all workers {} nodes, {:.0f} nodes/sec".format(
+        result.processes, engine.format_result(result.result), result.nodes, nps)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Validate games, run perft or search across several processes")
+    parser.add_argument('--processes', type=int, help="worker processes, defaults to the number of cores")
+    parser.add_argument('--backend', choices=(board.LIST_BACKEND, board.BITBOARD_BACKEND), default=board.LIST_BACKEND)
+    parser.add_argument('--cache', type=int, help="position cache entries per worker")
+    subparsers = parser.add_subparsers(dest='command')
+
+    validate = subparsers.add_parser('validate', help="replay every game of a PGN file")
+    validate.add_argument('path')
+    validate.add_argument('--chunksize', type=int, default=16, help="games sent to a worker at a time")
+
+    perft = subparsers.add_parser('perft', help="perft split at the root by move")
+    perft.add_argument('depth', type=int)
+    perft.add_argument('--fen', default=board.STARTING_FEN)
+    perft.add_argument('--divide', action='store_true', help="print the node count of every root move")
+
+    search = subparsers.add_parser('search', help="lazy SMP search sharing a transposition table")
+    search.add_argument('--fen', default=board.STARTING_FEN)
+    search.add_argument('--depth', type=int, default=5, help="depth of the main worker")
+    search.add_argument('--time', type=float, help="time budget in seconds")
+    search.add_argument('--nodes', type=int, help="node budget of each worker")
+    search.add_argument('--table-size', type=int, default=1 << 18, help="shared table entries, a power of two")
+    search.add_argument('--compare', action='store_true', help="also search with one process and report the speedup")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    processes = args.processes or multiprocessing.cpu_count()
+
+    start = timeit.default_timer()
+    if args.command == 'validate':
+        games, moves, errors = 0, 0, 0
+        for result in validate_pgn(args.path, processes, args.backend, args.cache, args.chunksize):
+            games += 1
+            moves += result.moves
+            if result.error is not None:
+                errors += 1
+                logger.warning("Game %d at offset %d: %s", games, result.offset, result.error)
+        seconds = timeit.default_timer() - start
+        print("{} games, {} moves, {} errors in {:.2f}s with {} processes".format(games, moves, errors, seconds, processes))
+        if seconds:
+            print("{:.1f} games/sec, {:.0f} moves/sec".format(games / seconds, moves / seconds))
+        return 1 if errors else 0
+
+    if args.command == 'search':
+        if processes > multiprocessing.cpu_count():
+            logger.warning("%d processes on %d cores, the workers share the cores so the search cannot get faster",
+                           processes, multiprocessing.cpu_count())
+        runs = [1, processes] if args.compare and processes > 1 else [processes]
+        results = []
+        for count in runs:
+            result = parallel_search(args.fen, count, args.depth, args.time, args.nodes, args.backend, args.table_size)
+            print(format_parallel_result(result))
+            results.append(result)
+        if len(results) == 2:
+            single, parallel = results
+            print("speedup {:.2f}x in time to depth {}, {:.2f}x in nodes/sec".format(
+                single.seconds / parallel.seconds if parallel.seconds else 0.0, parallel.result.depth,
+                (parallel.nodes / parallel.seconds) / (single.nodes / single.seconds)
+                if single.nodes and parallel.seconds and single.seconds else 0.0))
+            # what the helpers saved the main worker through the shared table, whatever the cores
+            print("main worker nodes to depth {}: {} alone, {} with helpers ({:.2f}x)".format(
+                parallel.result.depth, single.result.nodes, parallel.result.nodes,
+                float(single.result.nodes) / parallel.result.nodes if parallel.result.nodes else 0.0))
+        print("bestmove {}".format(engine.format_move(results[-1].result.move)) if results[-1].result.move else "no legal moves")
+        return 0
+
+    counts = parallel_divide(args.fen, args.depth, processes, args.backend, args.cache)
+    seconds = timeit.default_timer() - start
+    if args.divide:
+        for move in sorted(counts):
+            print("{}{} {}".format(board.c2n(*move[0]).lower(), board.c2n(*move[1]).lower(), counts[move]))
+    nodes = sum(counts.values())
+    print("{} nodes in {:.2f}s with {} processes, {:.0f} nodes/sec".format(
+        nodes, seconds, processes, nodes / seconds if seconds else 0.0))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,11 @@
-import logging
+import collections
 import copy
+import logging
+import random
 
-logging.basicConfig(level=logging.DEBUG)
+# the library only logs, configuring handlers and levels is left to the application
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
 
 # colors
 WHITE, BLACK = 'w', 'b'
@@ -9,6 +13,11 @@ WHITE, BLACK = 'w', 'b'
 # pieces
 KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN = 'k', 'q', 'r', 'b', 'n', 'p'
 
+# position representations
+LIST_BACKEND, BITBOARD_BACKEND = 'list', 'bitboard'
+
+STARTING_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
 def validate_name(name):
     if name not in (KING, QUEEN, ROOK, KNIGHT, BISHOP, PAWN):
         raise Exception, "Piece name {} is not allowed".format(name)
@@ -17,25 +26,182 @@ def validate_color(color):
     if color not in (WHITE, BLACK):
         raise Exception, "Color name {} is not allowed".format(color)
 
+def validate_backend(backend):
+    if backend not in (LIST_BACKEND, BITBOARD_BACKEND):
+        raise Exception, "Backend name {} is not allowed".format(backend)
+
 def c2n(x,y):
     return chr(ord('A')+x) + chr(ord('1')+y)
 
+def opposite_color(color):
+    return BLACK if color == WHITE else WHITE
+
+# directions looked along when searching for attackers of a square
+CARDINAL_DIRECTIONS = ( (0,1), (1,0), (0,-1), (-1,0) )
+DIAGONAL_DIRECTIONS = ( (1,1), (1,-1), (-1,-1), (-1,1) )
+KNIGHT_JUMPS = ( (-2, -1), (-1, -2), (-2, 1), (-1, 2), (2, -1), (1, -2), (2, 1), (1, 2) )
+
+# square index of x, y is y*8+x so A1 is 0, H1 is 7 and H8 is 63
+def square_index(x, y):
+    return y*8 + x
+
+## MOVE TABLES
+# built once at import and indexed by square_index, every entry holds (x, y) squares
+
+def jump_targets(jumps):
+    return tuple( tuple( (x+inc_x, y+inc_y) for inc_x, inc_y in jumps if 0 <= x+inc_x < 8 and 0 <= y+inc_y < 8 )
+                  for y in range(8) for x in range(8) )
+
+# the squares along each direction that stays on the board, nearest first
+def ray_targets(directions):
+    table = []
+    for y in range(8):
+        for x in range(8):
+            rays = []
+            for inc_x, inc_y in directions:
+                ray = []
+                new_x, new_y = x+inc_x, y+inc_y
+                while 0 <= new_x < 8 and 0 <= new_y < 8:
+                    ray.append( (new_x, new_y) )
+                    new_x, new_y = new_x+inc_x, new_y+inc_y
+                if ray:
+                    rays.append(tuple(ray))
+            table.append(tuple(rays))
+    return tuple(table)
+
+# pawn pushes by color, two squares from the pawns' starting rank
+def push_targets(direction, pawns_rank):
+    table = []
+    for y in range(8):
+        for x in range(8):
+            steps = 2 if y == pawns_rank else 1
+            table.append(tuple( (x, y+direction*i) for i in range(1, steps+1) if 0 <= y+direction*i < 8 ))
+    return tuple(table)
+
+KNIGHT_TARGETS = jump_targets(KNIGHT_JUMPS)
+KING_TARGETS = jump_targets(CARDINAL_DIRECTIONS + DIAGONAL_DIRECTIONS)
+SLIDER_RAYS = { ROOK : ray_targets(CARDINAL_DIRECTIONS),
+                BISHOP : ray_targets(DIAGONAL_DIRECTIONS),
+                QUEEN : ray_targets(CARDINAL_DIRECTIONS + DIAGONAL_DIRECTIONS) }
+PAWN_CAPTURE_TARGETS = { WHITE : jump_targets( ((-1,1), (1,1)) ),
+                         BLACK : jump_targets( ((-1,-1), (1,-1)) ) }
+PAWN_PUSH_TARGETS = { WHITE : push_targets(1, 1),
+                      BLACK : push_targets(-1, 6) }
+
+## ZOBRIST KEYS
+# random 64-bit numbers XORed together into a position key, generated from a
+# fixed seed so keys stay the same between runs and processes
+_zobrist_random = random.Random(0x5EED)
+
+ZOBRIST_PIECES = dict( ((color, name), tuple(_zobrist_random.getrandbits(64) for square in range(64)))
+                       for color in (WHITE, BLACK) for name in (KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN) )
+# in the same order as Board.castling_rights()
+ZOBRIST_CASTLING = tuple(_zobrist_random.getrandbits(64) for i in range(4))
+ZOBRIST_EN_PASSANT = tuple(_zobrist_random.getrandbits(64) for x in range(8))
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+
+# pieces are flyweights: Piece(name, color) always returns the same shared instance,
+# so boards only hold references and promotions do not allocate anything
 class Piece(object):
-    
-    def __init__(self, name, color):
-        validate_name(name)
-        validate_color(color)
+    # key is the (color, name) pair the bitboards and zobrist tables are indexed by
+    __slots__ = ('name', 'color', 'symbol', 'key')
+
+    instances = {}
+
+    def __new__(cls, name, color):
+        piece = cls.instances.get( (name, color) )
+        if piece is None:
+            validate_name(name)
+            validate_color(color)
+
+            piece = object.__new__(cls)
+            piece.name = name
+            piece.color = color
+            piece.symbol = name if name != PAWN else ''
+            piece.key = (color, name)
+            cls.instances[(name, color)] = piece
+        return piece
 
-        self.name = name
-        self.color = color
-        self.symbol = name if name != PAWN else ''
+    # unpickling goes through Piece() as well and gets the shared instance
+    def __reduce__(self):
+        return (Piece, (self.name, self.color))
 
     def __repr__(self):
         return "{}".format(self.name if self.color == BLACK else self.name.upper())
 
+# what a position allows, legal_moves is a tuple of (start, end) moves and status
+# is "Checkmate", "Stalemate" or None when there are moves left
+PositionInfo = collections.namedtuple('PositionInfo', 'legal_moves check status')
+
+# bounded cache of PositionInfo keyed by zobrist key, the least recently used
+# position is dropped once maxsize is reached, it can be shared by many boards
+class PositionCache(object):
+    def __init__(self, maxsize=100000):
+        if maxsize < 1:
+            raise Exception, "Cache size {} is not allowed".format(maxsize)
+
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        try:
+            info = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        # re-inserting moves the entry to the most recently used end
+        self.entries[key] = info
+        self.hits += 1
+        return info
+
+    def put(self, key, info):
+        self.entries.pop(key, None)
+        self.entries[key] = info
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return { 'size' : len(self.entries), 'maxsize' : self.maxsize,
+                 'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions }
+
+# the position is kept either as an 8x8 list of lists of pieces (the default)
+# or as bitboards, Board(backend=BITBOARD_BACKEND) returns a BitboardBoard
 class Board(object):
-    def __init__(self):
-        self.board = [[None for j in range(8)] for i in range(8)]
+    backend = LIST_BACKEND
+
+    # optional lookup sources read from memory-mapped files, shared by the boards they
+    # are set on (and their copies): book is a book.OpeningBook and endgames an
+    # endgame.EndgameTable, None when there is nothing to look up
+    book = None
+    endgames = None
+
+    def __new__(cls, backend=LIST_BACKEND, cache=None, fen=None):
+        validate_backend(backend)
+        if cls is Board and backend == BITBOARD_BACKEND:
+            cls = BitboardBoard
+        return object.__new__(cls)
+
+    def __init__(self, backend=LIST_BACKEND, cache=None, fen=None):
+        # optional PositionCache consulted for legal moves and game status
+        self.cache = cache
+
+        # a FEN position replaces the standard setup
+        if fen is not None:
+            self.set_fen(fen)
+            return
+
+        self.clear()
 
         # kingside and queenside castles availability
         self.castles_available = { WHITE : { KING : True, QUEEN : True },
@@ -45,6 +211,9 @@ class Board(object):
         self.half_move_clock = 0
         self.full_move_number = 1
 
+        # undo records for the moves played so far, see push() and pop()
+        self.undo_stack = []
+
         ## SET UP THE PIECES
         for color in (WHITE, BLACK):
             # move_direction and back_rank functions depend on the active_color variable
@@ -55,16 +224,123 @@ class Board(object):
 
             # setting up the pieces in the back rank
             for i, piece in enumerate( (ROOK, KNIGHT, BISHOP, QUEEN, KING, BISHOP, KNIGHT,ROOK) ):
-                self.board[i][back_rank] = Piece(piece, color)
+                self.set_piece(i, back_rank, Piece(piece, color))
 
             # pawns rank
             for i in range(8):
-                self.board[i][back_rank+direction] = Piece(PAWN, color)
+                self.set_piece(i, back_rank+direction, Piece(PAWN, color))
 
         # now setting the active_color for beginning of the game
         self.active_color = WHITE
 
-        logging.debug("Finished board setup")
+        self.reset_zobrist_key()
+
+        logger.debug("Finished board setup")
+
+    @classmethod
+    def from_fen(cls, fen, backend=LIST_BACKEND, cache=None):
+        return cls(backend=backend, cache=cache, fen=fen)
+
+    # a board without pieces, white to move and no castling rights, for setting up a
+    # position square by square, reset_zobrist_key needs calling once it is done
+    @classmethod
+    def empty(cls, backend=LIST_BACKEND, cache=None):
+        b = cls.__new__(cls, backend)
+        b.cache = cache
+        b.clear()
+        b.active_color = WHITE
+        b.castles_available = { WHITE : { KING : False, QUEEN : False },
+                                BLACK : { KING : False, QUEEN : False } }
+        b.en_passant_target = None
+        b.half_move_clock = 0
+        b.full_move_number = 1
+        b.undo_stack = []
+        b.reset_zobrist_key()
+        return b
+
+    # sets up the position from a FEN string, the game history starts over from it
+    def set_fen(self, fen):
+        fields = fen.split()
+        if len(fields) == 4:
+            # the move counters are often left out
+            fields += ['0', '1']
+        if len(fields) != 6:
+            raise Exception, "FEN {} does not have 6 fields".format(fen)
+        placement, active_color, castles, en_passant, half_move_clock, full_move_number = fields
+
+        ranks = placement.split('/')
+        if len(ranks) != 8:
+            raise Exception, "FEN {} does not have 8 ranks".format(fen)
+
+        self.clear()
+        for i, rank in enumerate(ranks):
+            y = 7 - i
+            x = 0
+            for symbol in rank:
+                if symbol in '12345678':
+                    x += int(symbol)
+                    continue
+                if x > 7:
+                    raise Exception, "FEN {} rank {} has more than 8 squares".format(fen, y+1)
+                self.set_piece(x, y, Piece(symbol.lower(), WHITE if symbol.isupper() else BLACK))
+                x += 1
+            if x != 8:
+                raise Exception, "FEN {} rank {} does not have 8 squares".format(fen, y+1)
+
+        # everything from check detection to the endgame tables needs the kings
+        for color in (WHITE, BLACK):
+            if self.material[color][KING] != 1:
+                raise Exception, "FEN {} does not have exactly one {} king".format(fen, 'white' if color == WHITE else 'black')
+
+        validate_color(active_color)
+        self.active_color = active_color
+
+        if castles != '-' and (not castles or set(castles) - set('KQkq')):
+            raise Exception, "FEN {} castling field is not valid".format(fen)
+        self.castles_available = { WHITE : { KING : 'K' in castles, QUEEN : 'Q' in castles },
+                                   BLACK : { KING : 'k' in castles, QUEEN : 'q' in castles } }
+
+        self.en_passant_target = None
+        if en_passant != '-':
+            if len(en_passant) != 2 or en_passant[0] not in 'abcdefgh' or en_passant[1] != '36'[active_color == WHITE]:
+                raise Exception, "FEN {} en passant square is not valid".format(fen)
+            self.en_passant_target = ord(en_passant[0]) - ord('a')
+
+        try:
+            self.half_move_clock = int(half_move_clock)
+            self.full_move_number = int(full_move_number)
+        except ValueError:
+            raise Exception, "FEN {} move counters are not valid".format(fen)
+
+        self.undo_stack = []
+        self.reset_zobrist_key()
+
+    def to_fen(self):
+        ranks = []
+        for y in range(7, -1, -1):
+            rank, empty = '', 0
+            for x in range(8):
+                piece = self.get_piece(x, y)
+                if piece is None:
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += str(piece)
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+
+        castles = ''.join( symbol for symbol, (color, side) in zip('KQkq', ( (WHITE, KING), (WHITE, QUEEN), (BLACK, KING), (BLACK, QUEEN) ))
+                           if self.castles_available[color][side] )
+
+        en_passant = '-'
+        if self.en_passant_target is not None:
+            en_passant = c2n(self.en_passant_target, self.back_rank() + 5*self.move_direction()).lower()
+
+        return ' '.join( ('/'.join(ranks), self.active_color, castles or '-', en_passant,
+                          str(self.half_move_clock), str(self.full_move_number)) )
 
     def __repr__(self):
         sep = "---------------------------------------"
@@ -73,7 +349,7 @@ class Board(object):
         for i in range(8):
             line = " {} |".format(i+1)
             for j in range(8):
-                piece = self.board[j][i]
+                piece = self.get_piece(j,i)
                 line += " {} |".format(' ' if piece is None else str(piece))
             line += "   "
             output.append(line)
@@ -88,13 +364,117 @@ class Board(object):
         
         return "\n".join(output)
 
+    # the zobrist key of the position computed from scratch
+    def hash_position(self):
+        key = self.en_passant_key()
+        for color in (WHITE, BLACK):
+            for square, piece in self.piece_squares[color].items():
+                key ^= ZOBRIST_PIECES[(color, piece.name)][square_index(*square)]
+        for i, available in enumerate(self.castling_rights()):
+            if available:
+                key ^= ZOBRIST_CASTLING[i]
+        if self.active_color == BLACK:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        return key
+
+    # push keeps the key up to date, this must be called instead whenever the position
+    # is set up by hand and it starts a new repetition history from that position
+    def reset_zobrist_key(self):
+        self.zobrist_key = self.hash_position()
+        self.legal_memo = None
+        # keys of the positions reached so far in the game, the current one last
+        self.key_history = [self.zobrist_key]
+
+    # the en-passant file only goes into the key when the active color has a pawn
+    # that could capture, so positions that only differ by a useless target are equal
+    def en_passant_key(self):
+        x = self.en_passant_target
+        if x is None:
+            return 0
+        y = self.back_rank() + 4*self.move_direction()
+        for pawn_x in (x-1, x+1):
+            if 0 <= pawn_x < 8:
+                piece = self.get_piece(pawn_x, y)
+                if piece is not None and piece.name == PAWN and piece.color == self.active_color:
+                    return ZOBRIST_EN_PASSANT[x]
+        return 0
+
+    # whether the current position has been reached count times with the same side to move,
+    # only the positions since the last pawn move or capture need to be looked at
+    def is_repetition(self, count=3):
+        key = self.zobrist_key
+        history = self.key_history
+        seen = 1
+        for i in range(len(history)-3, max(len(history)-2-self.half_move_clock, -1), -2):
+            if history[i] == key:
+                seen += 1
+                if seen >= count:
+                    return True
+        return False
+
     def flip_active_color(self):
         self.active_color = BLACK if self.active_color == WHITE else WHITE
 
+    # removes all the pieces from the board
+    def clear(self):
+        self.board = [[None for j in range(8)] for i in range(8)]
+        self.clear_piece_lists()
+
+    ## PIECE LISTS
+    # piece_squares maps each color's occupied (x, y) squares to their pieces, king_squares
+    # holds each color's king square (or None) and material the number of pieces by color
+    # and name, set_piece keeps them up to date so nothing needs to scan the board
+
+    def clear_piece_lists(self):
+        self.piece_squares = { WHITE : {}, BLACK : {} }
+        self.king_squares = { WHITE : None, BLACK : None }
+        self.material = dict( (color, dict( (name, 0) for name in (KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN) ))
+                              for color in (WHITE, BLACK) )
+
+    def track_piece(self, square, old_piece, piece):
+        if old_piece is not None:
+            color = old_piece.color
+            del self.piece_squares[color][square]
+            self.material[color][old_piece.name] -= 1
+            if old_piece.name == KING and self.king_squares[color] == square:
+                # hand set up positions may have more than one king, the lowest square is used
+                kings = [ s for s, p in self.piece_squares[color].items() if p.name == KING ]
+                self.king_squares[color] = min(kings) if kings else None
+
+        if piece is not None:
+            color = piece.color
+            self.piece_squares[color][square] = piece
+            self.material[color][piece.name] += 1
+            if piece.name == KING and (self.king_squares[color] is None or square < self.king_squares[color]):
+                self.king_squares[color] = square
+
+    # an independent board with the same position and history, sharing the cache
+    def copy(self):
+        other = copy.copy(self)
+        other.castles_available = dict( (color, dict(sides)) for color, sides in self.castles_available.items() )
+        other.undo_stack = list(self.undo_stack)
+        other.key_history = list(self.key_history)
+        other.piece_squares = dict( (color, dict(squares)) for color, squares in self.piece_squares.items() )
+        other.king_squares = dict(self.king_squares)
+        other.material = dict( (color, dict(counts)) for color, counts in self.material.items() )
+        self.copy_position(other)
+        return other
+
+    def copy_position(self, other):
+        other.board = [list(column) for column in self.board]
+
     # get a piece given its x and y coordinates
     def get_piece(self, x, y):
         return self.board[x][y]
 
+    # put a piece (or None to empty the square) on the given x and y coordinates
+    def set_piece(self, x, y, piece):
+        column = self.board[x]
+        old_piece = column[y]
+        column[y] = piece
+        if old_piece is not None or piece is not None:
+            self.track_piece( (x,y), old_piece, piece )
+
     # this provides the direction of movement for the current active side
     # white moves up (+1) while black moves down (-1)
     def move_direction(self):
@@ -140,60 +520,64 @@ class Board(object):
         return moves
         
     def get_possible_moves(self, x, y, attacking_only=False):
-
-        # main directions of movement
-        cardinal_moves = ( (0,1), (1,0), (0,-1), (-1,0) )
-        diagonal_moves = ( (1,1), (1,-1), (-1,-1), (-1,1) )
-        knight_moves   = ( (-2, -1), (-1, -2), (-2, 1), (-1, 2), (2, -1), (1, -2), (2, 1), (1, 2) )
-
-        # directions by piece (not including pawns)
-        moves_by_piece = { KING   : (cardinal_moves + diagonal_moves, 1),
-                           QUEEN  : (cardinal_moves + diagonal_moves, 7),
-                           KNIGHT : (knight_moves, 1),
-                           BISHOP : (diagonal_moves, 7),
-                           ROOK   : (cardinal_moves, 7) }
-                           
-        piece = self.get_piece(x,y)
+        board = self.board
+        square = y*8 + x
+        piece = board[x][y]
+        color = self.active_color
 
         allmoves = set()
-        pawn_capture = None
         if piece.name == PAWN:
-
-            direction = self.move_direction()
-            pawns_rank = self.back_rank() + direction
-
-            # is this the first move for the pawn
-            steps = 2 if y == pawns_rank else 1
-
-            # pawn can only move forward so only one possible path
-            increments = () if attacking_only else ( (0, direction), )
-            pawn_capture = False
-            
-            for increment in ( (-1, direction), (1, direction) ):
-                moves = self.generate_moves( (x,y), increment, 1, pawn_capture = True )
-                if moves:
-                    allmoves.update(moves)
+            for new_x, new_y in PAWN_CAPTURE_TARGETS[color][square]:
+                target = board[new_x][new_y]
+                if target is None:
+                    # captures need a piece to take unless it's en-passant
+                    if self.en_passant_target == new_x and self.back_rank()+5*self.move_direction() == new_y:
+                        allmoves.add( (new_x, new_y) )
+                elif target.color != color:
+                    allmoves.add( (new_x, new_y) )
+
+            # pawn can only move forward onto empty squares
+            if not attacking_only:
+                for new_x, new_y in PAWN_PUSH_TARGETS[color][square]:
+                    if board[new_x][new_y] is not None:
+                        break
+                    allmoves.add( (new_x, new_y) )
+
+        elif piece.name == KNIGHT or piece.name == KING:
+            for new_x, new_y in (KNIGHT_TARGETS if piece.name == KNIGHT else KING_TARGETS)[square]:
+                target = board[new_x][new_y]
+                if target is None or target.color != color:
+                    allmoves.add( (new_x, new_y) )
+
+            if piece.name == KING:
+                allmoves.update(self.get_castling_moves(x, y))
 
         else:
-            increments, steps = moves_by_piece[piece.name]
-        
-        for increment in increments:
-            moves = self.generate_moves( (x,y), increment, steps, pawn_capture=pawn_capture )
-            if moves:
-                allmoves.update(moves)
+            for ray in SLIDER_RAYS[piece.name][square]:
+                for new_x, new_y in ray:
+                    target = board[new_x][new_y]
+                    if target is None:
+                        allmoves.add( (new_x, new_y) )
+                        continue
+                    if target.color != color:
+                        allmoves.add( (new_x, new_y) )  # capture, can't move past it
+                    break
 
-        if piece.name == KING:
-            if self.castles_available[self.active_color][KING]:
-                moves = self.generate_moves( (x,y), (1,0), 2 )
-                if moves:
-                    allmoves.update(moves)
-            if self.castles_available[self.active_color][QUEEN]:
-                moves = self.generate_moves( (x,y), (-1,0), 2)
-                # for queenside castling we also need to make sure the rook can move
-                # to assure that all the square between rook and king are empty
-                if moves and self.generate_moves( (0, y), (1,0), 1):
-                    allmoves.update(moves)
-                    
+        return allmoves
+
+    # squares the king at x, y can reach by castling: the king is on its starting square,
+    # the right is still available, the rook is on its corner and every square between
+    # the king and the rook is empty
+    def get_castling_moves(self, x, y):
+        allmoves = set()
+        if (x, y) != (4, self.back_rank()):
+            return allmoves
+        rook = Piece(ROOK, self.active_color)
+        for side, rook_x, direction in ( (KING, 7, 1), (QUEEN, 0, -1) ):
+            if not self.castles_available[self.active_color][side] or self.get_piece(rook_x, y) is not rook:
+                continue
+            if all( self.get_piece(i, y) is None for i in range(x+direction, rook_x, direction) ):
+                allmoves.add( (x+2*direction, y) )
         return allmoves
 
     # checks a move's validity given the start and end coordinates
@@ -202,67 +586,84 @@ class Board(object):
         if start == end:
             return False
 
+        # a legal move is always a valid one
+        if self.cache is not None and (start, end) in self.position_info().legal_moves:
+            return True
+
         start_piece = self.get_piece(*start)
         end_piece = self.get_piece(*end)
 
-        logging.debug("Start piece is {}".format(start_piece))
-        logging.debug("End piece is {}".format(end_piece))
+        logger.debug("Start piece is %s", start_piece)
+        logger.debug("End piece is %s", end_piece)
 
         if start_piece is None:
             return False
 
         if start_piece.color != self.active_color:
-            logging.info("Start piece is not of the active color")
+            logger.info("Start piece is not of the active color")
             return False
         
         if end_piece is not None and start_piece.color == end_piece.color:
-            logging.info("Start piece and end piece are of the same color")
+            logger.info("Start piece and end piece are of the same color")
             return False
 
         moves = self.get_possible_moves(*start)
 
-        logging.debug("Possible squres to move into: {}".format(', '.join([c2n(*m) for m in moves])))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Possible squares to move into: %s", ', '.join([c2n(*m) for m in moves]))
         if end not in moves:
             return False
 
         return True
 
-    def is_check(self):
-        king = None
-        opponent_moves = set()
-
-        # need to get the moves from the opposing player's perspective
-        board = copy.deepcopy(self)
-        board.flip_active_color()
-
-        for i in range(8):
-            for j in range(8):
-                piece = self.get_piece(i,j)
-                if piece is None:
-                    continue
-                if piece.color != self.active_color:
-                    moves = board.get_possible_moves(i,j, attacking_only=True)
-                    if moves:
-                        opponent_moves.update(moves)
-                elif piece.name == KING and piece.color == self.active_color:
-                    king = (i,j)
-        
-        logging.debug("King: {}".format(c2n(*king)))
-        logging.debug("Squares under attack: {}".format(', '.join(sorted([c2n(*m) for m in opponent_moves]))))
-
-        if king in opponent_moves:
-            return True
+    # finds the square of the king of the given color
+    def find_king(self, color):
+        return self.king_squares[color]
+
+    # checks whether any piece of by_color attacks the square by looking
+    # outward from it and stopping at the first attacker found
+    def is_square_attacked(self, square, by_color):
+        board = self.board
+        index = square_index(*square)
+
+        # an attacking pawn sits where a pawn of the other color on this square could capture
+        for x, y in PAWN_CAPTURE_TARGETS[opposite_color(by_color)][index]:
+            piece = board[x][y]
+            if piece is not None and piece.name == PAWN and piece.color == by_color:
+                return True
+
+        for x, y in KNIGHT_TARGETS[index]:
+            piece = board[x][y]
+            if piece is not None and piece.name == KNIGHT and piece.color == by_color:
+                return True
+
+        for slider in (ROOK, BISHOP):
+            for ray in SLIDER_RAYS[slider][index]:
+                for x, y in ray:
+                    piece = board[x][y]
+                    if piece is not None:
+                        # the first piece along the ray either attacks the square or blocks it
+                        if piece.color == by_color and (piece.name in (slider, QUEEN) or (piece.name == KING and (x, y) == ray[0])):
+                            return True
+                        break
 
         return False
 
+    def is_check(self):
+        if self.cache is not None:
+            return self.position_info().check
+
+        king = self.find_king(self.active_color)
+        return self.is_square_attacked(king, opposite_color(self.active_color))
 
     def would_be_check(self, start, end):
-        board = copy.deepcopy(self)
-        
-        # need to not enforce_check otherwise we'd end up with infinite recursion
-        board.make_move(start, end, enforce_check=False)
-        board.flip_active_color()
-        return board.is_check()
+        # play the move in place and take it back afterwards, once push has
+        # handed the turn over the mover's king is looked up on the new position
+        self.push( (start, end) )
+        king = self.find_king(opposite_color(self.active_color))
+        check = self.is_square_attacked(king, self.active_color)
+        self.pop()
+        return check
 
     # performs all the state updates for the move
     # 1. checks validity & legality/check
@@ -277,29 +678,82 @@ class Board(object):
         end_x, end_y = end
 
         start_piece = self.get_piece(*start)
-        end_piece = self.get_piece(*end)
 
-        if not self.is_valid_move(start, end):
-            logging.info("Invalid move")
+        if enforce_check and self.current_legal_memo() is not None:
+            if end not in self.legal_moves_from(start):
+                logger.info("Invalid or illegal move")
+                return
+
+        elif enforce_check and self.cache is not None:
+            if (start, end) not in self.position_info().legal_moves:
+                logger.info("Invalid or illegal move")
+                return
+
+        elif not self.is_valid_move(start, end):
+            logger.info("Invalid move")
             return
 
-        if enforce_check:
+        elif enforce_check:
             # check if this a castling move and confirm that the 
             # king isn't currently in check or would be in check
             if start_piece.name == KING and abs(start_x-end_x) == 2:
                 if self.is_check():
-                    logging.info("Cannot castle while in check")
+                    logger.info("Cannot castle while in check")
                     return
                 
                 direction = (end_x - start_x)/2
-                if self.would_be_check(start, (start_x+direction, start_y)):
-                    logging.info("Cannot castle through check")
+                if self.is_square_attacked( (start_x+direction, start_y), opposite_color(self.active_color) ):
+                    logger.info("Cannot castle through check")
                     return
 
             if self.would_be_check(start, end):
-                logging.info("Move would result with king being in check")
+                logger.info("Move would result with king being in check")
                 return
 
+        self.push( (start, end) )
+
+        ## DONE
+        # the board is only formatted when the message is actually logged
+        logger.debug("Current board position\n%s\n", self)
+
+    # snapshot of the castling rights in the order
+    # white kingside, white queenside, black kingside, black queenside
+    def castling_rights(self):
+        return tuple(self.castles_available[color][side] for color in (WHITE, BLACK) for side in (KING, QUEEN))
+
+    def set_castling_rights(self, rights):
+        for i, (color, side) in enumerate( (c, s) for c in (WHITE, BLACK) for s in (KING, QUEEN) ):
+            self.castles_available[color][side] = rights[i]
+
+    # plays a (start, end) move in place without any validity or legality checks
+    # and records what is needed to take it back with pop()
+    # steps 2 to 7 of make_move happen here
+    def push(self, move):
+        start, end = move
+        start_x, start_y = start
+        end_x, end_y = end
+
+        start_piece = self.get_piece(start_x, start_y)
+        end_piece = self.get_piece(end_x, end_y)
+
+        # en-passant captures take the pawn next to the start square
+        captured, captured_square = end_piece, end
+        if start_piece.name == PAWN and end_piece is None and start_x != end_x:
+            captured_square = (end_x, start_y)
+            captured = self.get_piece(end_x, start_y)
+
+        castles = self.castling_rights()
+        self.undo_stack.append( (move, start_piece, captured, captured_square, castles, self.en_passant_target,
+                                 self.half_move_clock, self.full_move_number, self.zobrist_key) )
+
+        ## ZOBRIST KEY FOR THE MOVED AND CAPTURED PIECES
+        pieces = ZOBRIST_PIECES[start_piece.key]
+        key = self.zobrist_key ^ self.en_passant_key() ^ pieces[square_index(*start)]
+        if captured is not None:
+            key ^= ZOBRIST_PIECES[captured.key][square_index(*captured_square)]
+        if start_piece.name == PAWN and 7 - end_y == self.back_rank():
+            pieces = ZOBRIST_PIECES[(start_piece.color, QUEEN)]
+        key ^= pieces[square_index(*end)]
 
         ## CASTLING STATE
         if start_piece.name == KING:
@@ -313,6 +767,13 @@ class Board(object):
                 if start_x == 0: # A file
                     self.castles_available[self.active_color][QUEEN] = False
 
+        # taking a rook on its corner square loses the opponent that side's castling
+        if captured is not None and captured.name == ROOK and end_y == 7 - self.back_rank():
+            if end_x == 7:
+                self.castles_available[captured.color][KING] = False
+            if end_x == 0:
+                self.castles_available[captured.color][QUEEN] = False
+
         ## 50 MOVE RULE COUNTER
         if start_piece.name != PAWN and end_piece is None:
             self.half_move_clock += 1
@@ -320,20 +781,20 @@ class Board(object):
             self.half_move_clock = 0
         
         ## MOVE THE PIECE
-        self.board[start_x][start_y] = None
-        self.board[end_x][end_y] = start_piece
+        self.set_piece(start_x, start_y, None)
+        self.set_piece(end_x, end_y, start_piece)
 
         self.en_passant_target = None
         ## PROMOTION OR EN PASSANT POSSIBILITIES
         if start_piece.name == PAWN:
             # check if this is promotion and make the pawn a Queen
             if 7 - end_y == self.back_rank():
-                self.board[end_x][end_y] = Piece(QUEEN, self.active_color)
+                self.set_piece(end_x, end_y, Piece(QUEEN, self.active_color))
 
             ## was this an en-passant capture ?
-            if end_piece is None and start_x != end_x:
+            if captured_square != end:
                 # remove the captured pawn
-                self.board[end_x][start_y] = None
+                self.set_piece(end_x, start_y, None)
 
             ## UPDATE EN PASSANT STATE
             if abs(start_y-end_y) == 2:
@@ -346,8 +807,13 @@ class Board(object):
             if end_x < start_x: # is it queenside?
                 direction, rook_file = 1, 0
 
-            self.board[end_x+direction][start_y] = self.board[rook_file][start_y]
-            self.board[rook_file][start_y] = None
+            rook = self.get_piece(rook_file, start_y)
+            self.set_piece(end_x+direction, start_y, rook)
+            self.set_piece(rook_file, start_y, None)
+
+            if rook is not None:
+                rooks = ZOBRIST_PIECES[rook.key]
+                key ^= rooks[square_index(rook_file, start_y)] ^ rooks[square_index(end_x+direction, start_y)]
 
         ## MOVE COUNTER
         if self.active_color == BLACK:
@@ -356,28 +822,233 @@ class Board(object):
         ## FLIP ACTIVE COLOR
         self.flip_active_color()
 
-        ## DONE
-        logging.debug("Current board position\n{}\n".format(self))
+        ## ZOBRIST KEY FOR THE REMAINING STATE
+        for i, available in enumerate(self.castling_rights()):
+            if available != castles[i]:
+                key ^= ZOBRIST_CASTLING[i]
+        self.zobrist_key = key ^ self.en_passant_key() ^ ZOBRIST_BLACK_TO_MOVE
+        self.key_history.append(self.zobrist_key)
+
+    # the (start, end) move played last, None before any move
+    def last_move(self):
+        return self.undo_stack[-1][0] if self.undo_stack else None
+
+    # squares whose content the last move changed: the start and end squares, the square
+    # of a pawn taken en passant and the rook's squares when castling
+    def last_move_squares(self):
+        move, start_piece, captured, captured_square = self.undo_stack[-1][:4]
+        start, end = move
+        squares = set( (start, end, captured_square) )
+        if start_piece.name == KING and abs(start[0]-end[0]) == 2:
+            if end[0] > start[0]:
+                squares.update( ((7, start[1]), (end[0]-1, start[1])) )
+            else:
+                squares.update( ((0, start[1]), (end[0]+1, start[1])) )
+        return squares
+
+    # takes back the last move played with push() or make_move()
+    # and returns it as a (start, end) tuple
+    def pop(self):
+        (move, start_piece, captured, captured_square, castles, self.en_passant_target,
+         self.half_move_clock, self.full_move_number, self.zobrist_key) = self.undo_stack.pop()
+        self.key_history.pop()
+        start, end = move
+        start_x, start_y = start
+        end_x, end_y = end
+
+        self.flip_active_color()
+        self.set_castling_rights(castles)
+
+        # put back the rook first in case of castling
+        if start_piece.name == KING and abs(start_x-end_x) == 2:
+            direction, rook_file = -1, 7
+            if end_x < start_x:
+                direction, rook_file = 1, 0
+
+            self.set_piece(rook_file, start_y, self.get_piece(end_x+direction, start_y))
+            self.set_piece(end_x+direction, start_y, None)
+
+        # this also undoes a promotion as the original pawn is restored
+        self.set_piece(end_x, end_y, None)
+        self.set_piece(start_x, start_y, start_piece)
+        if captured is not None:
+            self.set_piece(captured_square[0], captured_square[1], captured)
+
+        return move
 
     def legal_moves_left(self):
-        # now test all the moves to see if any of them gets us out of check
-        for i in range(8):
-            for j in range(8):
-                piece = self.get_piece(i,j)
-                if piece is None:
-                    continue
-                if piece.color == self.active_color:
-                    moves = self.get_possible_moves(i,j)
-                    for move in moves:
-                        if not self.would_be_check( (i,j), move ):
-                            return True
+        memo = self.current_legal_memo()
+        if memo is not None:
+            return len(memo[1]) > 0
+        if self.cache is not None:
+            return len(self.position_info().legal_moves) > 0
+
+        # stops at the first legal move found
+        for move in self.iter_legal_moves():
+            return True
         return False
         
+    # all the (start, end) moves the active color can legally play, following the
+    # same rules as make_move including no castling out of or through check
+    def generate_legal_moves(self):
+        memo = self.current_legal_memo()
+        if memo is not None:
+            return list(memo[1])
+        if self.cache is not None:
+            return list(self.position_info().legal_moves)
+        return self.compute_legal_moves()
+
+    ## LEGAL MOVE MEMO
+    # the legal moves of one position worked out once for callers like the UI that ask about
+    # the same position many times: the zobrist key of the position, the tuple of its moves and
+    # a dict of start square to the tuple of its end squares. Being keyed by position it
+    # survives the push and pop pairs of the move checks, reset_zobrist_key throws it away.
+
+    def current_legal_memo(self):
+        memo = self.legal_memo
+        if memo is not None and memo[0] == self.zobrist_key:
+            return memo
+        return None
+
+    def legal_move_memo(self):
+        memo = self.current_legal_memo()
+        if memo is None:
+            moves = tuple(self.generate_legal_moves())
+            targets = {}
+            for start, end in moves:
+                targets.setdefault(start, []).append(end)
+            memo = (self.zobrist_key, moves, dict( (start, tuple(ends)) for start, ends in targets.items() ))
+            self.legal_memo = memo
+        return memo
+
+    # all the legal (start, end) moves of the position, in generate_legal_moves order
+    def all_legal_moves(self):
+        return self.legal_move_memo()[1]
+
+    # the squares the piece on square can legally move to, empty when it cannot move
+    # or it is not a piece of the active color
+    def legal_moves_from(self, square):
+        return self.legal_move_memo()[2].get(tuple(square), ())
+
+    # legal moves, check and checkmate/stalemate status of the position,
+    # looked up in the cache first when the board has one
+    def position_info(self):
+        if self.cache is not None:
+            info = self.cache.get(self.zobrist_key)
+            if info is not None:
+                return info
+
+        legal_moves = tuple(self.compute_legal_moves())
+        check = self.is_square_attacked(self.find_king(self.active_color), opposite_color(self.active_color))
+        status = None
+        if not legal_moves:
+            status = "Checkmate" if check else "Stalemate"
+        info = PositionInfo(legal_moves, check, status)
+
+        if self.cache is not None:
+            self.cache.put(self.zobrist_key, info)
+        return info
+
+    # generate_legal_moves without going through the cache
+    def compute_legal_moves(self):
+        return list(self.iter_legal_moves())
+
+    # castling is not allowed out of check or through an attacked square,
+    # the square the king lands on is checked like for any other move
+    def castling_through_check(self, start, end, in_check):
+        if in_check:
+            return True
+        return self.is_square_attacked( ((start[0]+end[0])/2, start[1]), opposite_color(self.active_color) )
+
+    # yields the legal (start, end) moves one at a time, the board is back to the
+    # position whenever a move is yielded so callers can stop at any point
+    def iter_legal_moves(self):
+        color = self.active_color
+        opponent = opposite_color(color)
+        king = self.find_king(color)
+        in_check = self.is_square_attacked(king, opponent)
+
+        # start then end squares in (x, y) order, so the moves come in the same order
+        # whatever the history of the piece lists and on both backends
+        for (i,j), piece in sorted(self.piece_squares[color].items()):
+            for move in sorted(self.get_possible_moves(i,j)):
+                if piece.name == KING and abs(move[0]-i) == 2 and self.castling_through_check( (i,j), move, in_check ):
+                    continue
+                self.push( ((i,j), move) )
+                # the king only needs to be looked up again when it is the one moving
+                attacked = self.is_square_attacked(move if piece.name == KING else king, opponent)
+                self.pop()
+                if not attacked:
+                    yield ((i,j), move)
+
+    # whether a single (start, end) move is legal, without logging why not
+    def is_legal_move(self, start, end):
+        memo = self.current_legal_memo()
+        if memo is not None:
+            return end in memo[2].get(start, ())
+
+        if self.cache is not None:
+            return (start, end) in self.position_info().legal_moves
+
+        piece = self.get_piece(*start)
+        if piece is None or piece.color != self.active_color or end not in self.get_possible_moves(*start):
+            return False
+
+        if piece.name == KING and abs(end[0]-start[0]) == 2:
+            if self.castling_through_check(start, end, self.is_square_attacked(start, opposite_color(self.active_color))):
+                return False
+
+        return not self.would_be_check(start, end)
+
+    # counts the leaf nodes of the legal move tree down to the given depth
+    def perft(self, depth):
+        if depth == 0:
+            return 1
+
+        moves = self.generate_legal_moves()
+        if depth == 1:
+            return len(moves)
+
+        nodes = 0
+        for move in moves:
+            self.push(move)
+            nodes += self.perft(depth-1)
+            self.pop()
+        return nodes
+
+    # perft split by root move, returns a dict of (start, end) move to node count
+    def divide(self, depth):
+        counts = {}
+        for move in self.generate_legal_moves():
+            self.push(move)
+            counts[move] = self.perft(depth-1)
+            self.pop()
+        return counts
+
+    # a move of the opening book for the current position, the heaviest one
+    # or one picked by weight when rng is given, None when out of the book
+    def book_move(self, rng=None):
+        if self.book is None:
+            return None
+        return self.book.choose(self, rng)
+
+    # the endgame.EndgameResult of the current position for the side to move,
+    # None when there are no endgame tables or the position is not in them
+    def endgame_result(self):
+        if self.endgames is None:
+            return None
+        return self.endgames.probe(self)
+
     # returns None if the game isn't done
     # returns the string reason for the end of game otherwise
     def game_over(self):
 
-        if not self.legal_moves_left():
+        if self.cache is not None:
+            status = self.position_info().status
+            if status is not None:
+                return status
+
+        elif not self.legal_moves_left():
             reason = "Stalemate"
             if self.is_check():
                 reason = "Checkmate"
@@ -387,27 +1058,284 @@ class Board(object):
         if self.half_move_clock == 100:
             return "Fifty-move Rule"
 
-        # Threefold repetition
+        if self.is_repetition(3):
+            return "Threefold Repetition"
+
+        if self.insufficient_material():
+            return "Insufficient Material"
 
-        # Insufficient material
         return None
+
+    # neither side can ever mate: bare kings, a single minor piece,
+    # or only bishops that all stand on squares of the same color
+    def insufficient_material(self):
+        white, black = self.material[WHITE], self.material[BLACK]
+        for name in (PAWN, ROOK, QUEEN):
+            if white[name] or black[name]:
+                return False
+
+        knights = white[KNIGHT] + black[KNIGHT]
+        bishops = white[BISHOP] + black[BISHOP]
+        if knights + bishops <= 1:
+            return True
+        if knights:
+            return False
+
+        shades = set( (x+y) % 2 for color in (WHITE, BLACK)
+                      for (x, y), piece in self.piece_squares[color].items() if piece.name == BISHOP )
+        return len(shades) == 1
         
+# builds one board per FEN string, for batch jobs that need many positions set up
+def load_fens(fens, backend=LIST_BACKEND, cache=None):
+    for fen in fens:
+        fen = fen.strip()
+        if fen:
+            yield Board(backend=backend, cache=cache, fen=fen)
+
+## BITBOARDS
+# bitboards use the square index so bit 0 is A1, bit 7 is H1 and bit 63 is H8
+
+# x, y coordinates for each square index
+SQUARE_COORDS = tuple( (i % 8, i // 8) for i in range(64) )
+
+def bits(bitboard):
+    while bitboard:
+        lowest = bitboard & -bitboard
+        yield lowest.bit_length() - 1
+        bitboard ^= lowest
+
+def jump_attacks(jumps):
+    table = []
+    for x, y in SQUARE_COORDS:
+        bitboard = 0
+        for inc_x, inc_y in jumps:
+            if 0 <= x+inc_x < 8 and 0 <= y+inc_y < 8:
+                bitboard |= 1 << square_index(x+inc_x, y+inc_y)
+        table.append(bitboard)
+    return tuple(table)
+
+def ray_masks(direction):
+    inc_x, inc_y = direction
+    table = []
+    for x, y in SQUARE_COORDS:
+        bitboard = 0
+        new_x, new_y = x+inc_x, y+inc_y
+        while 0 <= new_x < 8 and 0 <= new_y < 8:
+            bitboard |= 1 << square_index(new_x, new_y)
+            new_x, new_y = new_x+inc_x, new_y+inc_y
+        table.append(bitboard)
+    return tuple(table)
+
+KNIGHT_ATTACKS = jump_attacks(KNIGHT_JUMPS)
+KING_ATTACKS = jump_attacks(CARDINAL_DIRECTIONS + DIAGONAL_DIRECTIONS)
+PAWN_ATTACKS = { WHITE : jump_attacks( ((-1,1), (1,1)) ),
+                 BLACK : jump_attacks( ((-1,-1), (1,-1)) ) }
+
+# rays going towards higher square indexes have their nearest blocker on the lowest bit
+# and the ones going towards lower square indexes on the highest bit
+RAYS = dict( (direction, ray_masks(direction)) for direction in CARDINAL_DIRECTIONS + DIAGONAL_DIRECTIONS )
+POSITIVE_RAYS = { ROOK : ( RAYS[(0,1)], RAYS[(1,0)] ), BISHOP : ( RAYS[(1,1)], RAYS[(-1,1)] ) }
+NEGATIVE_RAYS = { ROOK : ( RAYS[(0,-1)], RAYS[(-1,0)] ), BISHOP : ( RAYS[(1,-1)], RAYS[(-1,-1)] ) }
+
+def slider_attacks(square, occupied, slider):
+    attacks = 0
+    for rays in POSITIVE_RAYS[slider]:
+        ray = rays[square]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1]
+        attacks |= ray
+    for rays in NEGATIVE_RAYS[slider]:
+        ray = rays[square]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[blockers.bit_length() - 1]
+        attacks |= ray
+    return attacks
+
+class BitboardBoard(Board):
+    backend = BITBOARD_BACKEND
+
+    def clear(self):
+        # one bitboard per piece type and color, plus a square to piece lookup
+        self.bitboards = dict( ((color, name), 0) for color in (WHITE, BLACK)
+                                                  for name in (KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN) )
+        self.occupied = { WHITE : 0, BLACK : 0 }
+        self.squares = [None] * 64
+        self.clear_piece_lists()
+
+    def copy_position(self, other):
+        other.bitboards = dict(self.bitboards)
+        other.occupied = dict(self.occupied)
+        other.squares = list(self.squares)
+
+    def get_piece(self, x, y):
+        return self.squares[y*8 + x]
+
+    def set_piece(self, x, y, piece):
+        square = y*8 + x
+        mask = 1 << square
+
+        squares, bitboards, occupied = self.squares, self.bitboards, self.occupied
+
+        old_piece = squares[square]
+        if old_piece is not None:
+            bitboards[old_piece.key] ^= mask
+            occupied[old_piece.color] ^= mask
+
+        squares[square] = piece
+        if piece is not None:
+            bitboards[piece.key] |= mask
+            occupied[piece.color] |= mask
+
+        if old_piece is not None or piece is not None:
+            self.track_piece( SQUARE_COORDS[square], old_piece, piece )
+
+    # same squares as Board.get_possible_moves, computed from the attack tables
+    def get_possible_moves(self, x, y, attacking_only=False):
+        square = y*8 + x
+        piece = self.squares[square]
+        allmoves = set( SQUARE_COORDS[target] for target in bits(self.target_bitboard(square, piece, attacking_only)) )
+        if piece.name == KING:
+            allmoves.update(self.get_castling_moves(x, y))
+        return allmoves
+
+    # bitboard of the squares the piece on square can move to, castling left out
+    def target_bitboard(self, square, piece, attacking_only=False):
+        color = self.active_color
+        own = self.occupied[color]
+        opponent = self.occupied[opposite_color(color)]
+        occupied = own | opponent
+
+        if piece.name == PAWN:
+            captures = PAWN_ATTACKS[color][square]
+            targets = captures & opponent
+
+            if self.en_passant_target is not None:
+                en_passant = 1 << square_index(self.en_passant_target, self.back_rank() + 5*self.move_direction())
+                if captures & en_passant & ~occupied:
+                    targets |= en_passant
+
+            direction = self.move_direction()
+            y = square >> 3
+            if not attacking_only and 0 <= y+direction < 8:
+                push = 1 << (square + 8*direction)
+                if not push & occupied:
+                    targets |= push
+                    # is this the first move for the pawn
+                    if y == self.back_rank() + direction:
+                        push = 1 << (square + 16*direction)
+                        if not push & occupied:
+                            targets |= push
+
+        elif piece.name == KNIGHT:
+            targets = KNIGHT_ATTACKS[square] & ~own
+        elif piece.name == KING:
+            targets = KING_ATTACKS[square] & ~own
+        elif piece.name == QUEEN:
+            targets = (slider_attacks(square, occupied, ROOK) | slider_attacks(square, occupied, BISHOP)) & ~own
+        else:
+            targets = slider_attacks(square, occupied, piece.name) & ~own
+        return targets
+
+    def is_square_attacked(self, square, by_color):
+        return self.is_index_attacked(square_index(*square), by_color, self.occupied[WHITE] | self.occupied[BLACK])
+
+    # is_square_attacked for a square index with the given occupancy, leaving out the
+    # attackers on the removed squares, so a move can be tested without playing it
+    def is_index_attacked(self, square, by_color, occupied, removed=0):
+        bitboards = self.bitboards
+        kept = ~removed
+
+        if PAWN_ATTACKS[opposite_color(by_color)][square] & bitboards[(by_color, PAWN)] & kept:
+            return True
+        if KNIGHT_ATTACKS[square] & bitboards[(by_color, KNIGHT)] & kept:
+            return True
+        if KING_ATTACKS[square] & bitboards[(by_color, KING)]:
+            return True
+
+        queens = bitboards[(by_color, QUEEN)]
+        rooks = (bitboards[(by_color, ROOK)] | queens) & kept
+        if rooks and slider_attacks(square, occupied, ROOK) & rooks:
+            return True
+        bishops = (bitboards[(by_color, BISHOP)] | queens) & kept
+        if bishops and slider_attacks(square, occupied, BISHOP) & bishops:
+            return True
+
+        return False
+
+    ## LEGALITY FROM THE BITBOARDS
+    # a move is legal when the mover's king is not attacked on the occupancy the move
+    # leaves behind, with the captured piece taken out of the attackers, so the
+    # legality tests do not need to push and pop the move
+
+    # whether the move between the start and end square indexes leaves the king of
+    # the side to move, on the king square index, attacked
+    def leaves_king_attacked(self, start, end, king):
+        piece = self.squares[start]
+        occupied = (self.occupied[WHITE] | self.occupied[BLACK]) & ~(1 << start) | (1 << end)
+        removed = 1 << end
+
+        if piece.name == PAWN and (start ^ end) & 7 and self.squares[end] is None:
+            # en passant takes the pawn beside the start square
+            captured = (start & ~7) | (end & 7)
+            occupied &= ~(1 << captured)
+            removed |= 1 << captured
+        elif piece.name == KING:
+            king = end
+            if abs((end & 7) - (start & 7)) == 2:
+                rook_start, rook_end = (start | 7, end - 1) if end > start else (start & ~7, end + 1)
+                if self.squares[rook_start] is not None:
+                    occupied = occupied & ~(1 << rook_start) | (1 << rook_end)
+
+        return self.is_index_attacked(king, opposite_color(self.active_color), occupied, removed)
+
+    def would_be_check(self, start, end):
+        king = self.find_king(self.active_color)
+        return self.leaves_king_attacked(square_index(*start), square_index(*end), square_index(*king))
+
+    # same moves in the same order as Board.iter_legal_moves
+    def iter_legal_moves(self):
+        color = self.active_color
+        opponent = opposite_color(color)
+        king = square_index(*self.find_king(color))
+        occupied = self.occupied[WHITE] | self.occupied[BLACK]
+        in_check = self.is_index_attacked(king, opponent, occupied)
+        squares = self.squares
+
+        for start_square in sorted(self.piece_squares[color]):
+            start = square_index(*start_square)
+            piece = squares[start]
+            ends = [ SQUARE_COORDS[end] for end in bits(self.target_bitboard(start, piece)) ]
+            castling = piece.name == KING and any(self.castles_available[color].values())
+            if castling:
+                ends.extend(self.get_castling_moves(*start_square))
+
+            for end_square in sorted(ends):
+                if castling and abs(end_square[0] - start_square[0]) == 2 and \
+                   self.castling_through_check(start_square, end_square, in_check):
+                    continue
+                if not self.leaves_king_attacked(start, square_index(*end_square), king):
+                    yield (start_square, end_square)
+
 def main():
+    logging.basicConfig(level=logging.DEBUG)
+
     b = Board()
     error = "Move entry should be of the form a2-a4 where a2 is the start square and a4 is the end square"
     while True:
-        logging.info("Current position")
-        logging.info(b)
+        logger.info("Current position")
+        logger.info("%s", b)
         move = raw_input("Enter move for {}:".format(b.active_color))
         start, end = move.lower().split('-')
         if len(start) != 2 or len(end) != 2:
-            logging.warning(error)
+            logger.warning(error)
             continue
         if start[0] not in 'abcdefgh' or end[0] not in 'abcdefgh':
-            logging.warning(error)
+            logger.warning(error)
             continue
         if start[1] not in '12345678' or end[1] not in '12345678':
-            logging.warning(error)
+            logger.warning(error)
             continue
         
         start = (ord(start[0]) - ord('a'), ord(start[1]) - ord('1'))
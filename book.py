@@ -0,0 +1,125 @@
+import argparse
+import collections
+import logging
+import random
+import struct
+import sys
+
+import board
+import index
+import pgn
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# the book is a header followed by (zobrist key, move, weight) records sorted by key,
+# the move packs the start and end square indexes in 6 bits each
+MAGIC = 'CHESSBOK'
+RECORD = struct.Struct('<QHH')
+MAX_WEIGHT = 0xffff
+
+# plies of every game that go into the book by default
+BOOK_DEPTH = 20
+
+def encode_move(move):
+    (start_x, start_y), (end_x, end_y) = move
+    return board.square_index(start_x, start_y) << 6 | board.square_index(end_x, end_y)
+
+def decode_move(code):
+    start, end = code >> 6, code & 63
+    return ( (start & 7, start >> 3), (end & 7, end >> 3) )
+
+# counts how often each move was played from each position in the first depth plies of the
+# games of a PGN file, moves played fewer than min_count times are left out
+def build_book(pgn_path, book_path, depth=BOOK_DEPTH, min_count=1, backend=board.LIST_BACKEND):
+    counts = collections.defaultdict(int)
+    def visit(ply, b):
+        if 0 < ply <= depth:
+            # keyed by the position the move was played from
+            counts[(b.key_history[-2], encode_move(b.last_move()))] += 1
+
+    games = 0
+    with open(pgn_path, 'rb') as f:
+        for game in pgn.read_games(f):
+            result = pgn.replay_game(game, backend, log_positions=False, visit=visit)
+            if result.error is not None:
+                logger.warning("Game at offset %d: %s", game.offset, result.error)
+            games += 1
+
+    entries = sorted( (key, move, min(count, MAX_WEIGHT))
+                      for (key, move), count in counts.items() if count >= min_count )
+    with open(book_path, 'wb') as out:
+        out.write(MAGIC)
+        index.write_records(out, entries, RECORD)
+
+    logger.info("Book of %d moves from %d games of %s", len(entries), games, pgn_path)
+    return len(entries)
+
+# an opening book read through mmap, set it as Board.book to have the
+# engine play its moves while the game is still in the book
+class OpeningBook(index.SortedRecords):
+    def __init__(self, path):
+        index.SortedRecords.__init__(self, path, MAGIC, RECORD)
+
+    # (move, weight) pairs for the position with this key, heaviest first
+    def lookup(self, key):
+        moves = [ (decode_move(code), weight) for record_key, code, weight in self.matching(key) ]
+        moves.sort(key=lambda entry: -entry[1])
+        return moves
+
+    # the book moves that are legal on the board, a clash of zobrist keys
+    # could otherwise bring in moves of another position
+    def moves(self, b):
+        return [ (move, weight) for move, weight in self.lookup(b.zobrist_key) if b.is_legal_move(*move) ]
+
+    # the heaviest book move, or one picked at random by weight when rng is given,
+    # None when the position is not in the book
+    def choose(self, b, rng=None):
+        moves = self.moves(b)
+        if not moves:
+            return None
+        if rng is None:
+            return moves[0][0]
+
+        pick = rng.uniform(0, sum(weight for move, weight in moves))
+        for move, weight in moves:
+            pick -= weight
+            if pick <= 0:
+                break
+        return move
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build an opening book from a PGN file or show the book moves of a position")
+    subparsers = parser.add_subparsers(dest='command')
+
+    build = subparsers.add_parser('build', help="write the opening book of a PGN file")
+    build.add_argument('pgn')
+    build.add_argument('book')
+    build.add_argument('--depth', type=int, default=BOOK_DEPTH, help="plies of each game to use")
+    build.add_argument('--min-count', type=int, default=1, help="times a move must be played to be kept")
+
+    query = subparsers.add_parser('query', help="list the book moves of a position")
+    query.add_argument('book')
+    query.add_argument('--fen', default=board.STARTING_FEN)
+    query.add_argument('--random', action='store_true', help="also pick a move at random by weight")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.command == 'build':
+        count = build_book(args.pgn, args.book, args.depth, args.min_count)
+        print("{} book moves written".format(count))
+        return 0
+
+    b = board.Board.from_fen(args.fen)
+    with OpeningBook(args.book) as opening_book:
+        for move, weight in opening_book.moves(b):
+            print("{}{} {}".format(board.c2n(*move[0]).lower(), board.c2n(*move[1]).lower(), weight))
+        if args.random:
+            move = opening_book.choose(b, random.Random())
+            if move is not None:
+                print("picked {}{}".format(board.c2n(*move[0]).lower(), board.c2n(*move[1]).lower()))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+import argparse
+import array
+import collections
+import logging
+import mmap
+import os
+import sys
+import timeit
+
+import board
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# the file holds one table per piece in TABLES order after the magic string, every table
+# stores a byte per position of a white king and piece against the black king: the number
+# of plies to mate plus one, DRAW_VALUE or ILLEGAL_VALUE for positions that cannot happen
+MAGIC = 'CHESSEGT'
+TABLES = (board.QUEEN, board.ROOK, board.PAWN)
+NAMES = { board.QUEEN : 'KQK', board.ROOK : 'KRK', board.PAWN : 'KPK' }
+DRAW_VALUE, ILLEGAL_VALUE = 0, 255
+
+# result for the side to move, plies is the number of plies until mate
+EndgameResult = collections.namedtuple('EndgameResult', 'result plies')
+WIN, LOSS, DRAW = 'win', 'loss', 'draw'
+
+# without pawns the board can be turned and mirrored 8 ways, so the white king is
+# kept on the a1-d1-d4 triangle, with a pawn it can only be mirrored left to right
+PAWNLESS_TRANSFORMS = ( lambda x, y: (x, y), lambda x, y: (7-x, y), lambda x, y: (x, 7-y), lambda x, y: (7-x, 7-y),
+                        lambda x, y: (y, x), lambda x, y: (7-y, x), lambda x, y: (y, 7-x), lambda x, y: (7-y, 7-x) )
+PAWN_TRANSFORMS = ( lambda x, y: (x, y), lambda x, y: (7-x, y) )
+
+TRIANGLE = tuple( (x, y) for y in range(4) for x in range(y, 4) )
+QUEENSIDE = tuple( (x, y) for y in range(8) for x in range(4) )
+
+# (white king squares, transforms) of each table
+LAYOUTS = { board.QUEEN : (TRIANGLE, PAWNLESS_TRANSFORMS),
+            board.ROOK : (TRIANGLE, PAWNLESS_TRANSFORMS),
+            board.PAWN : (QUEENSIDE, PAWN_TRANSFORMS) }
+KING_INDEXES = dict( (piece, dict( (square, i) for i, square in enumerate(LAYOUTS[piece][0]) )) for piece in TABLES )
+
+def table_size(piece):
+    return 2 * len(LAYOUTS[piece][0]) * 64 * 64
+
+# index in the table of piece of a position given by the white king, the white piece
+# and the black king squares, the position is first brought onto the stored white king squares
+def position_index(piece, king, other, black_king, black_to_move):
+    king_indexes = KING_INDEXES[piece]
+    for transform in LAYOUTS[piece][1]:
+        i = king_indexes.get(transform(*king))
+        if i is not None:
+            break
+    x, y = transform(*other)
+    black_x, black_y = transform(*black_king)
+    return (((black_to_move * len(king_indexes) + i) * 64 + y*8 + x) * 64) + black_y*8 + black_x
+
+def position_squares(piece, index):
+    king_squares = LAYOUTS[piece][0]
+    black_to_move, rest = divmod(index, len(king_squares) * 4096)
+    king, rest = divmod(rest, 4096)
+    other, black_king = divmod(rest, 64)
+    return king_squares[king], (other & 7, other >> 3), (black_king & 7, black_king >> 3), black_to_move
+
+## GENERATION
+# retrograde analysis: every legal position is set up once on a scratch board to find its
+# successors with the normal move generator, then the results spread backwards from the
+# mates, a white position wins as soon as one move reaches a lost black position and a black
+# position is lost once all its moves reach white wins, going through the plies in order
+# keeps the shortest mates for white and the longest defences for black
+
+def setup_position(b, piece, king, other, black_king, black_to_move):
+    b.clear()
+    b.set_piece(king[0], king[1], board.Piece(board.KING, board.WHITE))
+    b.set_piece(other[0], other[1], board.Piece(piece, board.WHITE))
+    b.set_piece(black_king[0], black_king[1], board.Piece(board.KING, board.BLACK))
+    b.active_color = board.BLACK if black_to_move else board.WHITE
+
+def is_legal_position(b, piece, king, other, black_king):
+    if max(abs(king[0]-black_king[0]), abs(king[1]-black_king[1])) <= 1:
+        return False
+    if piece == board.PAWN and other[1] in (0, 7):
+        return False
+    # the side that just moved cannot have left its king in check
+    waiting = board.opposite_color(b.active_color)
+    return not b.is_square_attacked(b.find_king(waiting), b.active_color)
+
+# the successors of the position set up on the board: table indexes of the positions
+# reached in the same table, None for captures (bare kings are a draw) and a
+# ('promotion', index) pair for a pawn becoming a queen, in the KQK table
+def successors(b, piece):
+    color = b.active_color
+    opponent = board.opposite_color(color)
+    found = []
+    for start, moving in b.piece_squares[color].items():
+        for end in b.get_possible_moves(*start):
+            b.push( (start, end) )
+            king = b.find_king(color)
+            if not b.is_square_attacked(king, opponent):
+                white, black = b.piece_squares[board.WHITE], b.piece_squares[board.BLACK]
+                if len(white) + len(black) < 3:
+                    found.append(None)
+                else:
+                    other, = [ square for square, p in white.items() if p.name != board.KING ]
+                    black_to_move = 1 if b.active_color == board.BLACK else 0
+                    index = position_index(white[other].name, b.find_king(board.WHITE), other,
+                                           b.find_king(board.BLACK), black_to_move)
+                    found.append( ('promotion', index) if white[other].name != piece else index )
+            b.pop()
+    return found
+
+# values of the table of piece, the KPK table needs the finished KQK table for promotions
+def generate_table(piece, queen_values=None):
+    size = table_size(piece)
+    half = size // 2
+    values = bytearray([ILLEGAL_VALUE]) * size
+    remaining = array.array('H', [0]) * size
+    predecessors = [None] * size
+    # positions to resolve by number of plies to mate
+    pending = collections.defaultdict(list)
+
+    b = board.Board()
+    b.set_castling_rights( (False, False, False, False) )
+    b.en_passant_target = None
+
+    for index in xrange(size):
+        king, other, black_king, black_to_move = position_squares(piece, index)
+        if len(set( (king, other, black_king) )) < 3:
+            continue
+        setup_position(b, piece, king, other, black_king, black_to_move)
+        if not is_legal_position(b, piece, king, other, black_king):
+            continue
+
+        values[index] = DRAW_VALUE
+        moves = successors(b, piece)
+        if black_to_move:
+            remaining[index] = len(moves)
+            if not moves and b.is_check():
+                pending[0].append(index)
+
+        for successor in moves:
+            if successor is None:
+                continue
+            if isinstance(successor, tuple):
+                value = queen_values[successor[1]]
+                if value not in (DRAW_VALUE, ILLEGAL_VALUE):
+                    pending[value].append(index)
+                continue
+            if predecessors[successor] is None:
+                predecessors[successor] = []
+            predecessors[successor].append(index)
+
+    plies = 0
+    while pending:
+        if plies + 1 >= ILLEGAL_VALUE:
+            raise Exception, "{} mates are too long for the table".format(NAMES[piece])
+        for index in pending.pop(plies, ()):
+            if values[index] != DRAW_VALUE:
+                continue  # a white position already won in fewer plies
+            values[index] = plies + 1
+
+            for predecessor in predecessors[index] or ():
+                if index < half:
+                    # a black position is lost when none of its moves avoids a white win
+                    remaining[predecessor] -= 1
+                    if not remaining[predecessor]:
+                        pending[plies+1].append(predecessor)
+                elif values[predecessor] == DRAW_VALUE:
+                    pending[plies+1].append(predecessor)
+        plies += 1
+
+    return values
+
+def build_tables(path):
+    tables = {}
+    with open(path, 'wb') as out:
+        out.write(MAGIC)
+        for piece in TABLES:
+            start = timeit.default_timer()
+            tables[piece] = generate_table(piece, tables.get(board.QUEEN))
+            out.write(tables[piece])
+            logger.info("%s table generated in %.1fs", NAMES[piece], timeit.default_timer() - start)
+    return tables
+
+## LOOKUP
+
+# the endgame tables read through mmap, set it as Board.endgames
+# to have the engine score these endings without searching them
+class EndgameTable(object):
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.offsets = {}
+        offset = len(MAGIC)
+        for piece in TABLES:
+            self.offsets[piece] = offset
+            offset += table_size(piece)
+
+        if os.fstat(self.file.fileno()).st_size != offset:
+            self.file.close()
+            raise Exception, "{} is not an endgame table file".format(path)
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise Exception, "{} is not an endgame table file".format(path)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # EndgameResult of the board's position for the side to move,
+    # None when the position is not one of the tables
+    def probe(self, b):
+        white, black = b.piece_squares[board.WHITE], b.piece_squares[board.BLACK]
+        if len(white) + len(black) != 3 or any(b.castling_rights()):
+            return None
+
+        strong = board.WHITE if len(white) == 2 else board.BLACK
+        weak = board.opposite_color(strong)
+        others = [ square for square, p in b.piece_squares[strong].items() if p.name != board.KING ]
+        king, black_king = b.find_king(strong), b.find_king(weak)
+        if len(others) != 1 or king is None or black_king is None:
+            return None
+        other = others[0]
+        piece = b.piece_squares[strong][other].name
+        if piece not in self.offsets:
+            return None
+
+        if strong == board.BLACK:
+            # the tables are for white, turn the board around
+            king, other, black_king = [ (x, 7-y) for x, y in (king, other, black_king) ]
+        black_to_move = 0 if b.active_color == strong else 1
+
+        value = ord(self.data[self.offsets[piece] + position_index(piece, king, other, black_king, black_to_move)])
+        if value == ILLEGAL_VALUE:
+            return None
+        if value == DRAW_VALUE:
+            return EndgameResult(DRAW, 0)
+        return EndgameResult(LOSS if black_to_move else WIN, value - 1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the KQK, KRK and KPK endgame tables or probe a position")
+    subparsers = parser.add_subparsers(dest='command')
+
+    build = subparsers.add_parser('build', help="generate the tables into a file")
+    build.add_argument('path')
+
+    probe = subparsers.add_parser('probe', help="look up a position")
+    probe.add_argument('path')
+    probe.add_argument('fen')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'build':
+        build_tables(args.path)
+        return 0
+
+    b = board.Board.from_fen(args.fen)
+    with EndgameTable(args.path) as tables:
+        result = tables.probe(b)
+    if result is None:
+        print("not in the tables")
+        return 1
+    print("{} in {} plies".format(result.result, result.plies) if result.result != DRAW else DRAW)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,322 @@
+import argparse
+import collections
+import logging
+import sys
+import timeit
+
+import board
+import book
+import endgame
+
+PIECE_VALUES = { board.PAWN : 100, board.KNIGHT : 320, board.BISHOP : 330,
+                 board.ROOK : 500, board.QUEEN : 900, board.KING : 0 }
+
+# small bonus for pieces near the centre, indexed by distance from it (0 to 3)
+CENTRE_BONUS = { board.PAWN : (20, 10, 0, 0), board.KNIGHT : (20, 10, 0, -20), board.BISHOP : (10, 5, 0, -10),
+                 board.ROOK : (0, 0, 0, 0), board.QUEEN : (5, 5, 0, -5), board.KING : (-20, -10, 0, 10) }
+
+MATE = 100000
+INFINITY = MATE + 1
+# scores beyond this are mates, stored in the transposition table relative to the node
+MATE_BOUND = MATE - 1000
+
+# transposition table bound types
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# how often (in nodes) the time budget is checked
+CHECK_EVERY = 512
+
+# outcome of a search, move is the best (start, end) move found or None when there are
+# no legal moves, score is in centipawns for the side to move and pv the expected line
+SearchResult = collections.namedtuple('SearchResult', 'move score depth nodes seconds pv')
+
+class SearchAborted(Exception):
+    pass
+
+def centre_distance(x, y):
+    return max(abs(2*x - 7), abs(2*y - 7)) // 2
+
+# static evaluation in centipawns from the point of view of the side to move
+def evaluate(b):
+    score = 0
+    for color, sign in ( (board.WHITE, 1), (board.BLACK, -1) ):
+        for (i,j), piece in b.piece_squares[color].items():
+            value = PIECE_VALUES[piece.name] + CENTRE_BONUS[piece.name][centre_distance(i,j)]
+            if piece.name == board.PAWN:
+                # pawns are worth more the closer they get to promotion
+                value += 5 * (j - 1 if color == board.WHITE else 6 - j)
+            score += sign * value
+    return score if b.active_color == board.WHITE else -score
+
+# the piece taken by a move, including en-passant captures
+def captured_piece(b, move):
+    start, end = move
+    piece = b.get_piece(*end)
+    if piece is None and start[0] != end[0] and b.get_piece(*start).name == board.PAWN:
+        piece = b.get_piece(end[0], start[1])
+    return piece
+
+# negamax alpha-beta with iterative deepening, quiescence search on captures
+# and a transposition table of a fixed number of entries indexed by zobrist key
+class Engine(object):
+    def __init__(self, table_size=1 << 18):
+        if table_size & (table_size - 1):
+            raise Exception, "Table size {} is not a power of two".format(table_size)
+        self.table_size = table_size
+        self.table = [None] * table_size
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.nodes = 0
+        self.table_hits = 0
+        self.killers = collections.defaultdict(list)
+        self.history = collections.defaultdict(int)
+
+    def clear(self):
+        self.table = [None] * self.table_size
+        self.reset_stats()
+
+    ## TRANSPOSITION TABLE
+    # entries are (key, depth, score, bound, move) tuples, always replaced,
+    # load and save are the only methods that touch the table itself
+
+    def load(self, key):
+        return self.table[key & (self.table_size - 1)]
+
+    def save(self, entry):
+        self.table[entry[0] & (self.table_size - 1)] = entry
+
+    def probe(self, key, ply):
+        entry = self.load(key)
+        if entry is None or entry[0] != key:
+            return None
+        self.table_hits += 1
+        key, depth, score, bound, move = entry
+        if score > MATE_BOUND:
+            score -= ply
+        elif score < -MATE_BOUND:
+            score += ply
+        return depth, score, bound, move
+
+    def store(self, key, ply, depth, score, bound, move):
+        if score > MATE_BOUND:
+            score += ply
+        elif score < -MATE_BOUND:
+            score -= ply
+        self.save( (key, depth, score, bound, move) )
+
+    ## MOVE ORDERING
+    # table move first, then captures by most valuable victim / least valuable attacker,
+    # then the killer moves of this ply and finally the quiet moves by history score
+
+    def order_moves(self, b, moves, ply, table_move):
+        killers = self.killers[ply]
+        def sort_key(move):
+            if move == table_move:
+                return -10000000
+            victim = captured_piece(b, move)
+            if victim is not None:
+                return -1000000 - 10 * PIECE_VALUES[victim.name] + PIECE_VALUES[b.get_piece(*move[0]).name] // 100
+            if move in killers:
+                return -900000 + killers.index(move)
+            return -self.history[move]
+        moves.sort(key=sort_key)
+        return moves
+
+    def check_budget(self):
+        self.nodes += 1
+        if self.nodes % CHECK_EVERY == 0:
+            if self.node_limit is not None and self.nodes >= self.node_limit:
+                raise SearchAborted
+            if self.deadline is not None and timeit.default_timer() >= self.deadline:
+                raise SearchAborted
+            if self.stop is not None and self.stop():
+                raise SearchAborted
+
+    ## SEARCH
+
+    def quiescence(self, b, alpha, beta, ply):
+        self.check_budget()
+
+        stand_pat = evaluate(b)
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+
+        captures = [ move for move in b.generate_legal_moves() if captured_piece(b, move) is not None ]
+        for move in self.order_moves(b, captures, ply, None):
+            b.push(move)
+            score = -self.quiescence(b, -beta, -alpha, ply+1)
+            b.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def negamax(self, b, depth, alpha, beta, ply):
+        # repeating a position, the fifty-move rule or insufficient material is a draw
+        if ply and (b.half_move_clock >= 100 or b.is_repetition(2) or b.insufficient_material()):
+            return 0
+        # positions of the endgame tables are known, no need to search them
+        if ply and b.endgames is not None:
+            known = b.endgame_result()
+            if known is not None:
+                if known.result == endgame.WIN:
+                    return MATE - ply - known.plies
+                if known.result == endgame.LOSS:
+                    return -MATE + ply + known.plies
+                return 0
+
+        if depth <= 0:
+            return self.quiescence(b, alpha, beta, ply)
+
+        self.check_budget()
+
+        key = b.zobrist_key
+        table_move = None
+        entry = self.probe(key, ply)
+        if entry is not None:
+            entry_depth, score, bound, table_move = entry
+            if ply and entry_depth >= depth:
+                if bound == EXACT:
+                    return score
+                if bound == LOWER and score >= beta:
+                    return score
+                if bound == UPPER and score <= alpha:
+                    return score
+
+        moves = b.generate_legal_moves()
+        if not moves:
+            return -MATE + ply if b.is_check() else 0
+
+        original_alpha = alpha
+        best_score, best_move = -INFINITY, None
+        for move in self.order_moves(b, moves, ply, table_move):
+            b.push(move)
+            score = -self.negamax(b, depth-1, -beta, -alpha, ply+1)
+            b.pop()
+
+            if score > best_score:
+                best_score, best_move = score, move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if captured_piece(b, move) is None:
+                    killers = self.killers[ply]
+                    if move not in killers:
+                        killers.insert(0, move)
+                        del killers[2:]
+                    self.history[move] += depth * depth
+                break
+
+        if best_score <= original_alpha:
+            bound = UPPER
+        elif best_score >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        self.store(key, ply, depth, best_score, bound, best_move)
+        return best_score
+
+    # follows the table moves from the current position
+    def principal_variation(self, b, max_length):
+        pv = []
+        keys = set()
+        while len(pv) < max_length and b.zobrist_key not in keys:
+            keys.add(b.zobrist_key)
+            entry = self.probe(b.zobrist_key, 0)
+            if entry is None or entry[3] is None or not b.is_legal_move(*entry[3]):
+                break
+            pv.append(entry[3])
+            b.push(entry[3])
+        for move in pv:
+            b.pop()
+        return pv
+
+    # searches the board's position one depth at a time until max_depth, the time limit
+    # (in seconds) or the node limit is reached, or stop() returns True, and returns the result
+    # of the deepest completed iteration, info is called with the SearchResult of every iteration
+    # and depths are the depths of the iterations when not all of 1 to max_depth
+    def search(self, b, max_depth=64, time_limit=None, node_limit=None, info=None, stop=None, depths=None):
+        self.reset_stats()
+        self.node_limit = node_limit
+        self.stop = stop
+        start = timeit.default_timer()
+        self.deadline = start + time_limit if time_limit is not None else None
+
+        result = SearchResult(None, 0, 0, 0, 0.0, [])
+        moves = b.generate_legal_moves()
+        if not moves:
+            return result
+
+        # a book move is played without searching
+        move = b.book_move()
+        if move is not None:
+            return SearchResult(move, 0, 0, 0, timeit.default_timer() - start, [move])
+
+        undo_depth = len(b.undo_stack)
+        for depth in depths if depths is not None else range(1, max_depth+1):
+            try:
+                score = self.negamax(b, depth, -INFINITY, INFINITY, 0)
+            except SearchAborted:
+                # take back the moves the aborted search left on the board
+                while len(b.undo_stack) > undo_depth:
+                    b.pop()
+                break
+
+            pv = self.principal_variation(b, depth)
+            result = SearchResult(pv[0] if pv else moves[0], score, depth, self.nodes,
+                                  timeit.default_timer() - start, pv)
+            if info is not None:
+                info(result)
+            if abs(score) > MATE_BOUND:
+                break
+
+        if result.depth == 0:
+            # not even depth 1 finished, any legal move is better than none
+            result = SearchResult(moves[0], 0, 0, self.nodes, timeit.default_timer() - start, [])
+        return result._replace(nodes=self.nodes, seconds=timeit.default_timer() - start)
+
+def format_move(move):
+    return (board.c2n(*move[0]) + board.c2n(*move[1])).lower()
+
+def format_result(result):
+    nps = result.nodes / result.seconds if result.seconds else 0.0
+    return "depth {} score {} nodes {} time {:.2f}s nps {:.0f} pv {}".format(
+        result.depth, result.score, result.nodes, result.seconds, nps, ' '.join(format_move(m) for m in result.pv))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search the best move of a position")
+    parser.add_argument('--fen', default=board.STARTING_FEN)
+    parser.add_argument('--backend', choices=(board.LIST_BACKEND, board.BITBOARD_BACKEND), default=board.LIST_BACKEND)
+    parser.add_argument('--depth', type=int, default=64, help="maximum depth")
+    parser.add_argument('--time', type=float, help="time budget in seconds")
+    parser.add_argument('--nodes', type=int, help="node budget")
+    parser.add_argument('--cache', type=int, help="position cache entries")
+    parser.add_argument('--book', help="opening book file, see book.py")
+    parser.add_argument('--endgames', help="endgame tables file, see endgame.py")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.time is None and args.nodes is None and args.depth == 64:
+        args.time = 5.0
+
+    cache = board.PositionCache(args.cache) if args.cache else None
+    b = board.Board.from_fen(args.fen, backend=args.backend, cache=cache)
+    if args.book:
+        b.book = book.OpeningBook(args.book)
+    if args.endgames:
+        b.endgames = endgame.EndgameTable(args.endgames)
+
+    def info(result):
+        print(format_result(result))
+
+    result = Engine().search(b, args.depth, args.time, args.nodes, info)
+    if result.move is None:
+        print("no legal moves")
+        return 1
+    print("bestmove {}".format(format_move(result.move)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
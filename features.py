@@ -0,0 +1,299 @@
+import argparse
+import logging
+import random
+import sys
+import timeit
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import board
+import packed
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# planes of the piece tensor, white pieces first
+PLANES = tuple( (color, name) for color in (board.WHITE, board.BLACK)
+                for name in (board.KING, board.QUEEN, board.ROOK, board.BISHOP, board.KNIGHT, board.PAWN) )
+KING, QUEEN, ROOK, BISHOP, KNIGHT, PAWN = range(6)
+
+# positions turned into features at a time by feature_batches
+BATCH_SIZE = 65536
+
+def require_numpy():
+    if numpy is None:
+        raise Exception, "NumPy is needed for batch features"
+
+## BITBOARD OPERATIONS
+# every position of a batch has a uint64 bitboard per piece plane, bit y*8+x being the
+# square x, y as in board.square_index, and all the operations work on the whole batch
+
+if numpy is not None:
+    FILES = [ numpy.uint64(0x0101010101010101 << x) for x in range(8) ]
+    SQUARE_BITS = numpy.array([ 1 << square for square in range(64) ], dtype=numpy.uint64)
+    POPCOUNTS = numpy.array([ bin(byte).count('1') for byte in range(256) ], dtype=numpy.uint8)
+
+def shift(bitboards, dx, dy):
+    amount = dy*8 + dx
+    if amount > 0:
+        shifted = numpy.left_shift(bitboards, numpy.uint64(amount))
+    else:
+        shifted = numpy.right_shift(bitboards, numpy.uint64(-amount))
+    # squares that went off one side of the board came back on the other
+    for x in range(dx) if dx > 0 else range(8+dx, 8):
+        shifted &= ~FILES[x]
+    return shifted
+
+def popcount(bitboards):
+    counts = POPCOUNTS[bitboards.view(numpy.uint8)]
+    return counts.reshape(bitboards.shape + (8,)).sum(axis=-1, dtype=numpy.int32)
+
+def jump_attacks(pieces, jumps):
+    attacks = numpy.zeros_like(pieces)
+    for dx, dy in jumps:
+        attacks |= shift(pieces, dx, dy)
+    return attacks
+
+# squares reached along each direction up to and including the first occupied one
+def slider_attacks(pieces, empty, directions):
+    attacks = numpy.zeros_like(pieces)
+    for dx, dy in directions:
+        ray = pieces
+        for i in range(7):
+            ray = shift(ray, dx, dy)
+            attacks |= ray
+            ray = ray & empty
+    return attacks
+
+def pawn_attacks(pawns, color):
+    direction = 1 if color == board.WHITE else -1
+    return shift(pawns, -1, direction) | shift(pawns, 1, direction)
+
+## BATCH FEATURES
+
+# N x PACKED_SIZE uint8 array of the positions, given as boards, packed positions
+# or a packed.PositionArray (which is used without copying)
+def packed_array(positions):
+    require_numpy()
+    if isinstance(positions, packed.PositionArray):
+        data = positions.data
+    else:
+        data = ''.join( position if isinstance(position, str) else packed.pack(position) for position in positions )
+    return numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, packed.PACKED_SIZE)
+
+# N x 12 x 8 x 8 uint8 planes, indexed by position, plane, y and x
+def piece_planes(data):
+    squares = numpy.empty( (len(data), 64), dtype=numpy.uint8 )
+    squares[:, 0::2] = data[:, :32] & 0xf
+    squares[:, 1::2] = data[:, :32] >> 4
+
+    planes = numpy.empty( (len(data), len(PLANES), 64), dtype=numpy.uint8 )
+    for plane, key in enumerate(PLANES):
+        planes[:, plane] = squares == packed.NIBBLES[key]
+    return planes.reshape(len(data), len(PLANES), 8, 8)
+
+def plane_bitboards(planes):
+    return numpy.dot(planes.reshape(planes.shape[0], planes.shape[1], 64).astype(numpy.uint64), SQUARE_BITS)
+
+def unpack_bitboards(bitboards):
+    return ( (bitboards[..., numpy.newaxis] & SQUARE_BITS) != 0 ).astype(numpy.uint8).reshape(bitboards.shape + (8, 8))
+
+# features of the positions as a dict of arrays with one row per position:
+#   planes             N x 12 x 8 x 8 pieces, white king, queen, rook, bishop, knight, pawn then black
+#   side_to_move       N, 1 when black is to move
+#   castling           N x 4 castling rights in Board.castling_rights() order
+#   material           N x 2 x 6 number of pieces by color (white, black) and piece (as in planes)
+#   attacks            N x 2 x 8 x 8 squares attacked by each color, whatever stands on them
+#   mobility           N x 2 x 6 squares the pieces of each kind can move to (en passant and castling
+#                      left out), counting every square once however many pieces of the kind reach it
+#   king_zone_attacks  N x 2 squares of the king and around it that the opponent attacks
+#   pawn_shield        N x 2 own pawns around the king or one rank ahead of that
+def batch_features(positions):
+    data = packed_array(positions)
+    planes = piece_planes(data)
+    bitboards = plane_bitboards(planes)
+
+    occupied = numpy.bitwise_or.reduce(bitboards, axis=1)
+    empty = ~occupied
+    by_color = numpy.stack( (numpy.bitwise_or.reduce(bitboards[:, :6], axis=1),
+                             numpy.bitwise_or.reduce(bitboards[:, 6:], axis=1)), axis=1 )
+
+    flags = data[:, 32]
+    features = { 'planes' : planes,
+                 'side_to_move' : (flags & packed.BLACK_TO_MOVE).astype(numpy.uint8),
+                 'castling' : numpy.stack([ (flags >> (packed.CASTLING_SHIFT + i)) & 1 for i in range(4) ], axis=1),
+                 'material' : planes.reshape(len(data), 2, 6, 64).sum(axis=-1, dtype=numpy.int32) }
+
+    attacks = numpy.zeros( (len(data), 2), dtype=numpy.uint64 )
+    mobility = numpy.zeros( (len(data), 2, 6), dtype=numpy.int32 )
+    king_zone_attacks = numpy.zeros( (len(data), 2), dtype=numpy.int32 )
+    pawn_shield = numpy.zeros( (len(data), 2), dtype=numpy.int32 )
+    zones = numpy.zeros( (len(data), 2), dtype=numpy.uint64 )
+
+    for side, color in enumerate( (board.WHITE, board.BLACK) ):
+        pieces = bitboards[:, 6*side:6*side+6]
+        own = by_color[:, side]
+        direction = 1 if color == board.WHITE else -1
+
+        targets = [None] * 6
+        targets[KING] = jump_attacks(pieces[:, KING], board.CARDINAL_DIRECTIONS + board.DIAGONAL_DIRECTIONS)
+        targets[QUEEN] = slider_attacks(pieces[:, QUEEN], empty, board.CARDINAL_DIRECTIONS + board.DIAGONAL_DIRECTIONS)
+        targets[ROOK] = slider_attacks(pieces[:, ROOK], empty, board.CARDINAL_DIRECTIONS)
+        targets[BISHOP] = slider_attacks(pieces[:, BISHOP], empty, board.DIAGONAL_DIRECTIONS)
+        targets[KNIGHT] = jump_attacks(pieces[:, KNIGHT], board.KNIGHT_JUMPS)
+        targets[PAWN] = pawn_attacks(pieces[:, PAWN], color)
+
+        for kind in range(6):
+            attacks[:, side] |= targets[kind]
+
+        # pawns only take on their attacked squares and move straight to empty ones,
+        # two squares from their starting rank
+        single = shift(pieces[:, PAWN], 0, direction) & empty
+        double = shift(single & numpy.uint64(0xff << (8 * (2 if color == board.WHITE else 5))), 0, direction) & empty
+        opponent = by_color[:, 1-side]
+        moves = list(targets)
+        moves[PAWN] = (targets[PAWN] & opponent) | single | double
+        for kind in range(6):
+            mobility[:, side, kind] = popcount(moves[kind] & ~own)
+
+        zones[:, side] = pieces[:, KING] | targets[KING]
+        pawn_shield[:, side] = popcount( (zones[:, side] | shift(zones[:, side], 0, direction)) & pieces[:, PAWN] )
+
+    for side in range(2):
+        king_zone_attacks[:, side] = popcount(zones[:, side] & attacks[:, 1-side])
+
+    features['attacks'] = unpack_bitboards(attacks)
+    features['mobility'] = mobility
+    features['king_zone_attacks'] = king_zone_attacks
+    features['pawn_shield'] = pawn_shield
+    return features
+
+# batch_features over successive slices of the positions, for collections too big for one batch
+def feature_batches(positions, batch_size=BATCH_SIZE):
+    if isinstance(positions, packed.PositionArray):
+        for start in xrange(0, len(positions), batch_size):
+            chunk = packed.PositionArray()
+            chunk.data = positions.data[start*packed.PACKED_SIZE:(start+batch_size)*packed.PACKED_SIZE]
+            yield batch_features(chunk)
+        return
+
+    batch = []
+    for position in positions:
+        batch.append(position)
+        if len(batch) == batch_size:
+            yield batch_features(batch)
+            batch = []
+    if batch:
+        yield batch_features(batch)
+
+## PER BOARD FEATURES
+# the same features worked out one board at a time with the Board methods, kept
+# to check batch_features against and to compare the two in the benchmark
+
+def board_features(boards):
+    require_numpy()
+    boards = list(boards)
+    features = { 'planes' : numpy.zeros( (len(boards), len(PLANES), 8, 8), dtype=numpy.uint8 ),
+                 'side_to_move' : numpy.zeros( len(boards), dtype=numpy.uint8 ),
+                 'castling' : numpy.zeros( (len(boards), 4), dtype=numpy.uint8 ),
+                 'material' : numpy.zeros( (len(boards), 2, 6), dtype=numpy.int32 ),
+                 'attacks' : numpy.zeros( (len(boards), 2, 8, 8), dtype=numpy.uint8 ),
+                 'mobility' : numpy.zeros( (len(boards), 2, 6), dtype=numpy.int32 ),
+                 'king_zone_attacks' : numpy.zeros( (len(boards), 2), dtype=numpy.int32 ),
+                 'pawn_shield' : numpy.zeros( (len(boards), 2), dtype=numpy.int32 ) }
+    plane_indexes = dict( (key, plane) for plane, key in enumerate(PLANES) )
+    colors = (board.WHITE, board.BLACK)
+
+    for n, b in enumerate(boards):
+        features['side_to_move'][n] = b.active_color == board.BLACK
+        features['castling'][n] = b.castling_rights()
+        for x in range(8):
+            for y in range(8):
+                piece = b.get_piece(x, y)
+                if piece is not None:
+                    plane = plane_indexes[(piece.color, piece.name)]
+                    features['planes'][n, plane, y, x] = 1
+                    features['material'][n, plane // 6, plane % 6] += 1
+                for side, color in enumerate(colors):
+                    features['attacks'][n, side, y, x] = b.is_square_attacked( (x, y), color )
+
+        # get_possible_moves is for the side to move, so each side gets
+        # a copy of the board without castling and en passant
+        scratch = b.copy()
+        scratch.set_castling_rights( (False, False, False, False) )
+        scratch.en_passant_target = None
+        for side, color in enumerate(colors):
+            scratch.active_color = color
+            targets = [ set() for kind in range(6) ]
+            for (x, y), piece in scratch.piece_squares[color].items():
+                targets[plane_indexes[(color, piece.name)] % 6].update(scratch.get_possible_moves(x, y))
+            for kind in range(6):
+                features['mobility'][n, side, kind] = len(targets[kind])
+
+            king = b.find_king(color)
+            if king is None:
+                continue
+            zone = [ (x, y) for x in range(king[0]-1, king[0]+2) for y in range(king[1]-1, king[1]+2)
+                     if 0 <= x < 8 and 0 <= y < 8 ]
+            direction = 1 if color == board.WHITE else -1
+            shield = set(zone) | set( (x, y+direction) for x, y in zone if 0 <= y+direction < 8 )
+            features['king_zone_attacks'][n, side] = sum( 1 for x, y in zone if features['attacks'][n, 1-side, y, x] )
+            features['pawn_shield'][n, side] = sum( 1 for x, y in shield
+                                                    if b.get_piece(x, y) == board.Piece(board.PAWN, color) )
+    return features
+
+## BENCHMARK
+
+# positions along random games, every ply of every game
+def random_positions(count, seed=0, backend=board.LIST_BACKEND):
+    rng = random.Random(seed)
+    boards = []
+    b = board.Board(backend=backend)
+    while len(boards) < count:
+        moves = b.generate_legal_moves()
+        if not moves or b.game_over() is not None:
+            b = board.Board(backend=backend)
+            continue
+        b.push(rng.choice(moves))
+        boards.append(b.copy())
+    return boards
+
+def compare_features(expected, found):
+    return [ name for name in sorted(expected) if not numpy.array_equal(expected[name], found[name]) ]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the batch features against the per board path")
+    parser.add_argument('--positions', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=(board.LIST_BACKEND, board.BITBOARD_BACKEND), default=board.LIST_BACKEND)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    require_numpy()
+    boards = random_positions(args.positions, args.seed, args.backend)
+    positions = packed.PositionArray.from_boards(boards)
+
+    timings = []
+    for name, compute, source in ( ('per board', board_features, boards),
+                                   ('batch from boards', batch_features, boards),
+                                   ('batch from packed', batch_features, positions) ):
+        start = timeit.default_timer()
+        features = compute(source)
+        seconds = timeit.default_timer() - start
+        timings.append( (name, seconds, features) )
+
+    expected = timings[0][2]
+    failed = False
+    for name, seconds, features in timings:
+        mismatches = compare_features(expected, features)
+        failed = failed or bool(mismatches)
+        print("{:<18} {:8.3f}s {:10.0f} positions/sec {:6.1f}x{}".format(
+            name, seconds, len(boards) / seconds, timings[0][1] / seconds,
+            "  MISMATCH " + ' '.join(mismatches) if mismatches else ''))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+import argparse
+import collections
+import heapq
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import timeit
+
+import board
+import pgn
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# the index file is a header followed by fixed-width (zobrist key, game offset, ply, move number)
+# records sorted by key, so all the games that reached a position are next to each other and
+# a lookup is a binary search over the memory-mapped file whatever its size, the move number
+# is stored as games set up from a FEN tag do not start at move 1 with white to move
+MAGIC = 'CHESSIX2'
+RECORD = struct.Struct('<QQHH')
+
+# records sorted in memory before being written out as a run for the final merge
+RUN_SIZE = 1000000
+
+# a game that reached the looked up position, ply is the number of moves played
+# before it (0 for the starting position) and move_number the matching full move
+IndexMatch = collections.namedtuple('IndexMatch', 'offset ply move_number')
+
+def write_records(f, records, record_struct=RECORD):
+    pack = record_struct.pack
+    for record in records:
+        f.write(pack(*record))
+
+def read_records(f, record_struct=RECORD):
+    unpack = record_struct.unpack
+    while True:
+        data = f.read(record_struct.size)
+        if len(data) < record_struct.size:
+            return
+        yield unpack(data)
+
+# (key, offset, ply, move number) for every position of every game, games that cannot
+# be fully replayed keep the positions reached before the bad move
+def game_records(f, backend=board.LIST_BACKEND):
+    for game in pgn.read_games(f):
+        records = []
+        def visit(ply, b):
+            records.append( (b.zobrist_key, game.offset, ply, min(b.full_move_number, 0xffff)) )
+
+        result = pgn.replay_game(game, backend, log_positions=False, visit=visit)
+        if result.error is not None:
+            logger.warning("Game at offset %d: %s", game.offset, result.error)
+        for record in records:
+            yield record
+
+# builds the index of a PGN file, the records are sorted in runs of run_size
+# that are merged into the index file, returns the number of records written
+def build_index(pgn_path, index_path, backend=board.LIST_BACKEND, run_size=RUN_SIZE):
+    directory = os.path.dirname(os.path.abspath(index_path))
+    runs, records, count = [], [], 0
+
+    def flush():
+        records.sort()
+        run = tempfile.TemporaryFile(dir=directory)
+        write_records(run, records)
+        run.seek(0)
+        runs.append(run)
+        del records[:]
+
+    try:
+        with open(pgn_path, 'rb') as f:
+            for record in game_records(f, backend):
+                records.append(record)
+                if len(records) >= run_size:
+                    flush()
+        if records or not runs:
+            flush()
+
+        with open(index_path, 'wb') as out:
+            out.write(MAGIC)
+            for record in heapq.merge(*[ read_records(run) for run in runs ]):
+                out.write(RECORD.pack(*record))
+                count += 1
+    finally:
+        for run in runs:
+            run.close()
+
+    logger.info("Indexed %d positions of %s in %d runs", count, pgn_path, len(runs))
+    return count
+
+# a file of fixed-width records after a magic string, sorted by their first field and
+# read through mmap so only the pages a lookup touches are loaded
+class SortedRecords(object):
+    def __init__(self, path, magic, record_struct):
+        self.magic = magic
+        self.record_struct = record_struct
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size < len(magic) or (self.size - len(magic)) % record_struct.size:
+            self.file.close()
+            raise Exception, "{} is not a {} file".format(path, magic)
+
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(magic)] != magic:
+            self.close()
+            raise Exception, "{} is not a {} file".format(path, magic)
+        self.count = (self.size - len(magic)) // record_struct.size
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        return self.record_struct.unpack_from(self.data, len(self.magic) + i*self.record_struct.size)
+
+    # position of the first record whose key is not below key
+    def lower_bound(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # all the records with this key, in file order
+    def matching(self, key):
+        records = []
+        i = self.lower_bound(key)
+        while i < self.count:
+            record = self.record(i)
+            if record[0] != key:
+                break
+            records.append(record)
+            i += 1
+        return records
+
+class PositionIndex(SortedRecords):
+    def __init__(self, path):
+        SortedRecords.__init__(self, path, MAGIC, RECORD)
+
+    # IndexMatch of every position with this zobrist key, in game order
+    def lookup(self, key):
+        return [ IndexMatch(offset, ply, move_number) for record_key, offset, ply, move_number in self.matching(key) ]
+
+    # the games that reached the board's current position
+    def games(self, b):
+        return self.lookup(b.zobrist_key)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index the positions of a PGN file and look up the games that reached a position")
+    subparsers = parser.add_subparsers(dest='command')
+
+    build = subparsers.add_parser('build', help="write the position index of a PGN file")
+    build.add_argument('pgn')
+    build.add_argument('index')
+    build.add_argument('--backend', choices=(board.LIST_BACKEND, board.BITBOARD_BACKEND), default=board.LIST_BACKEND)
+    build.add_argument('--run-size', type=int, default=RUN_SIZE, help="records sorted in memory at a time")
+
+    query = subparsers.add_parser('query', help="list the games that reached a position")
+    query.add_argument('index')
+    query.add_argument('--fen', default=board.STARTING_FEN)
+    query.add_argument('--pgn', help="PGN file the index was built from, to show the game headers")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    start = timeit.default_timer()
+    if args.command == 'build':
+        count = build_index(args.pgn, args.index, args.backend, args.run_size)
+        print("{} positions indexed in {:.2f}s".format(count, timeit.default_timer() - start))
+        return 0
+
+    b = board.Board.from_fen(args.fen)
+    with PositionIndex(args.index) as index:
+        matches = index.games(b)
+    seconds = timeit.default_timer() - start
+
+    games = open(args.pgn, 'rb') if args.pgn else None
+    try:
+        for match in matches:
+            line = "offset {} move {}".format(match.offset, match.move_number)
+            if games is not None:
+                headers = pgn.read_game_at(games, match.offset).headers
+                line += " {} - {} {}".format(headers.get('White', '?'), headers.get('Black', '?'), headers.get('Result', '*'))
+            print(line)
+    finally:
+        if games is not None:
+            games.close()
+    print("{} matches in {:.3f}ms".format(len(matches), seconds * 1000))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import collections
+import contextlib
+import timeit
+
+import board
+
+# Board methods counted and timed while instrumentation is enabled. The wrappers are
+# only installed by enable() and removed by disable(), so a disabled instrumentation
+# leaves the original methods in place and costs nothing.
+METHODS = ( 'make_move', 'push', 'pop', 'copy', 'get_possible_moves', 'is_square_attacked',
+            'is_check', 'would_be_check', 'is_legal_move', 'generate_legal_moves',
+            'legal_moves_left', 'game_over', 'get_castling_moves', 'target_bitboard', 'is_index_attacked' )
+
+# counters derived from the instrumented calls
+MOVES_GENERATED, CHECK_TESTS, COPIES = 'moves_generated', 'check_tests', 'copies'
+
+# the counter each method adds to, the bitboard backend generates moves and tests checks
+# through target_bitboard and is_index_attacked, which its get_possible_moves and
+# is_square_attacked call in turn
+METHOD_COUNTERS = { 'get_possible_moves' : MOVES_GENERATED, 'get_castling_moves' : MOVES_GENERATED,
+                    'target_bitboard' : MOVES_GENERATED, 'is_square_attacked' : CHECK_TESTS,
+                    'is_index_attacked' : CHECK_TESTS, 'copy' : COPIES }
+
+calls = collections.defaultdict(int)
+# time spent in each method, including the time of the instrumented methods it calls
+seconds = collections.defaultdict(float)
+counters = collections.defaultdict(int)
+# instrumented calls in progress by counter, only the outermost call of a counter
+# adds to it so a method calling another one of the same counter is counted once
+active = collections.defaultdict(int)
+
+# (class, method name) to the original method
+originals = {}
+
+def wrap(name, method):
+    counter = METHOD_COUNTERS.get(name)
+
+    def instrumented(self, *args, **kwargs):
+        start = timeit.default_timer()
+        active[counter] += 1
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            active[counter] -= 1
+        seconds[name] += timeit.default_timer() - start
+        calls[name] += 1
+        if counter is None or active[counter]:
+            pass
+        elif counter == MOVES_GENERATED:
+            # target_bitboard returns a bitboard of the target squares rather than a set
+            counters[counter] += bin(result).count('1') if isinstance(result, (int, long)) else len(result)
+        else:
+            counters[counter] += 1
+        return result
+
+    instrumented.__name__ = method.__name__
+    instrumented.__doc__ = method.__doc__
+    return instrumented
+
+def is_enabled():
+    return bool(originals)
+
+def enable():
+    if originals:
+        return
+    for cls in (board.Board, board.BitboardBoard):
+        for name in METHODS:
+            if name in cls.__dict__:
+                originals[(cls, name)] = cls.__dict__[name]
+                setattr(cls, name, wrap(name, cls.__dict__[name]))
+
+def disable():
+    for (cls, name), method in originals.items():
+        setattr(cls, name, method)
+    originals.clear()
+
+def reset():
+    calls.clear()
+    seconds.clear()
+    counters.clear()
+
+@contextlib.contextmanager
+def enabled():
+    was_enabled = is_enabled()
+    enable()
+    try:
+        yield
+    finally:
+        if not was_enabled:
+            disable()
+
+# everything measured since the last reset as plain dicts
+def snapshot():
+    return { 'calls' : dict(calls), 'seconds' : dict(seconds),
+             'counters' : dict( (name, counters.get(name, 0)) for name in (MOVES_GENERATED, CHECK_TESTS, COPIES) ) }
+
+def format_report():
+    lines = []
+    for name in sorted(calls, key=lambda name: -seconds[name]):
+        lines.append("{:22} {:>10} calls {:10.3f}s {:8.2f} us/call".format(
+            name, calls[name], seconds[name], seconds[name] * 1e6 / calls[name]))
+    for name in (MOVES_GENERATED, CHECK_TESTS, COPIES):
+        lines.append("{:22} {:>10}".format(name, counters.get(name, 0)))
+    return '\n'.join(lines)
@@ -0,0 +1,158 @@
+import argparse
+import logging
+import random
+import socket
+import sys
+import threading
+import timeit
+import Queue
+
+import board
+import engine
+import server
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# random games worked out before the test starts so that choosing
+# the moves does not count in the measured latencies
+def random_games(count, length, seed=0):
+    rng = random.Random(seed)
+    games = []
+    for i in range(count):
+        b = board.Board()
+        moves = []
+        while len(moves) < length and b.game_over() is None:
+            move = rng.choice(b.generate_legal_moves())
+            b.push(move)
+            moves.append(engine.format_move(move))
+        games.append(moves)
+    return games
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+class Client(object):
+    def __init__(self, host, port):
+        self.socket = socket.create_connection( (host, port) )
+        self.file = self.socket.makefile('rb')
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def send(self, line):
+        self.socket.sendall(line + '\n')
+
+    # the words of the next line from the server that starts with one of the prefixes
+    def expect(self, *prefixes):
+        while True:
+            line = self.file.readline()
+            if not line:
+                raise Exception, "Connection closed by the server"
+            words = line.split()
+            if words and words[0] in prefixes:
+                return words
+
+    # waits for the server to answer the move: the position line with that move
+    # or an error about the game, returns the words of the error or None
+    def wait_for_move(self, game_id, move):
+        while True:
+            words = self.expect('position', 'error')
+            if words[0] == 'error' and words[1:2] in ([game_id], ['-']):
+                return words
+            if words[0] == 'position' and words[1:3] == [game_id, move]:
+                return None
+
+    # plays the moves as a new game and returns the latency of each of them in seconds
+    def play(self, moves):
+        self.send('new')
+        words = self.expect('game', 'error')
+        if words[0] == 'error':
+            raise Exception, "New game: {}".format(' '.join(words[2:]))
+        game_id = words[1]
+        # the starting position is sent right after the game id
+        self.expect('position')
+
+        latencies = []
+        for move in moves:
+            start = timeit.default_timer()
+            self.send("move {} {}".format(game_id, move))
+            error = self.wait_for_move(game_id, move)
+            if error is not None:
+                raise Exception, "Move {} of game {}: {}".format(move, game_id, ' '.join(error[2:]))
+            latencies.append(timeit.default_timer() - start)
+        return latencies
+
+def worker(host, port, games, latencies, errors):
+    client = Client(host, port)
+    try:
+        while True:
+            try:
+                moves = games.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                latencies.extend(client.play(moves))
+            except Exception as e:
+                errors.append(str(e))
+                logger.warning("%s", e)
+    finally:
+        client.close()
+
+# plays the games over the given number of connections at once, returns the move latencies and errors
+def run(host, port, games, connections):
+    queue = Queue.Queue()
+    for moves in games:
+        queue.put(moves)
+
+    latencies, errors = [], []
+    threads = [ threading.Thread(target=worker, args=(host, port, queue, latencies, errors)) for i in range(connections) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the move latency of a game server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=server.DEFAULT_PORT)
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--moves', type=int, default=40, help="moves per game at most")
+    parser.add_argument('--connections', type=int, default=20, help="games played at the same time")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--spawn', action='store_true', help="start a server in this process on a free port")
+    parser.add_argument('--workers', type=int, default=server.DEFAULT_WORKERS, help="executor threads of the spawned server")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    games = random_games(args.games, args.moves, args.seed)
+
+    game_server = None
+    if args.spawn:
+        game_server = server.GameServer(args.host, 0, args.workers)
+        args.port = game_server.address[1]
+        thread = threading.Thread(target=game_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    start = timeit.default_timer()
+    try:
+        latencies, errors = run(args.host, args.port, games, args.connections)
+    finally:
+        if game_server is not None:
+            game_server.shutdown()
+    seconds = timeit.default_timer() - start
+
+    print("{} games, {} moves, {} errors in {:.2f}s over {} connections, {:.0f} moves/sec".format(
+        len(games), len(latencies), len(errors), seconds, args.connections, len(latencies) / seconds if seconds else 0.0))
+    print("latency p50 {:.1f}ms p99 {:.1f}ms max {:.1f}ms".format(
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, max(latencies or [0]) * 1000))
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+import struct
+
+import board
+
+# a position packed into 37 bytes: 32 bytes of pieces, two squares per byte in square_index
+# order with the even square in the low nibble, then a flags byte (black to move and the
+# castling rights), the en-passant file, the half move clock and the full move number.
+# Packed positions are plain strings so they are immutable, hashable and compare equal
+# when the positions (including the move counters) are the same.
+PACKED_FORMAT = struct.Struct('<32sBBBH')
+PACKED_SIZE = PACKED_FORMAT.size
+
+BLACK_TO_MOVE = 1
+# castling rights use the next four bits, in the order of Board.castling_rights()
+CASTLING_SHIFT = 1
+NO_EN_PASSANT = 0xff
+
+# nibble of each piece, 0 is an empty square and black pieces have the 8 bit set
+NIBBLES = dict( ((color, name), nibble | (8 if color == board.BLACK else 0))
+                for color in (board.WHITE, board.BLACK)
+                for nibble, name in enumerate( (board.KING, board.QUEEN, board.ROOK,
+                                                board.BISHOP, board.KNIGHT, board.PAWN), 1 ) )
+NIBBLE_PIECES = [None] * 16
+for (color, name), nibble in NIBBLES.items():
+    NIBBLE_PIECES[nibble] = board.Piece(name, color)
+
+# for every byte value the (square offset, piece) pairs it holds, None when a nibble is not a piece
+BYTE_PIECES = []
+for byte in range(256):
+    pieces = tuple( (offset, NIBBLE_PIECES[nibble]) for offset, nibble in enumerate( (byte & 0xf, byte >> 4) ) if nibble )
+    BYTE_PIECES.append(None if any(piece is None for offset, piece in pieces) else pieces)
+
+def pack(b):
+    if not 0 <= b.half_move_clock <= 0xff or not 0 <= b.full_move_number <= 0xffff:
+        raise Exception, "Move counters {} {} do not fit a packed position".format(b.half_move_clock, b.full_move_number)
+
+    squares = bytearray(32)
+    for color in (board.WHITE, board.BLACK):
+        for (x, y), piece in b.piece_squares[color].items():
+            square = y*8 + x
+            squares[square >> 1] |= NIBBLES[(color, piece.name)] << (4 * (square & 1))
+
+    flags = BLACK_TO_MOVE if b.active_color == board.BLACK else 0
+    for i, available in enumerate(b.castling_rights()):
+        if available:
+            flags |= 1 << (CASTLING_SHIFT + i)
+
+    en_passant = NO_EN_PASSANT if b.en_passant_target is None else b.en_passant_target
+    return PACKED_FORMAT.pack(str(squares), flags, en_passant, b.half_move_clock, b.full_move_number)
+
+# a new board set up from a packed position, with no game history before it
+def unpack(packed, backend=board.LIST_BACKEND, cache=None):
+    if len(packed) != PACKED_SIZE:
+        raise Exception, "Packed position has {} bytes instead of {}".format(len(packed), PACKED_SIZE)
+    squares, flags, en_passant, half_move_clock, full_move_number = PACKED_FORMAT.unpack(packed)
+
+    b = board.Board.empty(backend, cache)
+    for i, byte in enumerate(bytearray(squares)):
+        if not byte:
+            continue
+        pieces = BYTE_PIECES[byte]
+        if pieces is None:
+            raise Exception, "Packed position has an unknown piece on square {} or {}".format(2*i, 2*i+1)
+        for offset, piece in pieces:
+            square = 2*i + offset
+            b.set_piece(square & 7, square >> 3, piece)
+
+    b.active_color = board.BLACK if flags & BLACK_TO_MOVE else board.WHITE
+    b.set_castling_rights([ bool(flags & (1 << (CASTLING_SHIFT + i))) for i in range(4) ])
+
+    if en_passant != NO_EN_PASSANT and en_passant > 7:
+        raise Exception, "Packed position has an unknown en passant file {}".format(en_passant)
+    b.en_passant_target = None if en_passant == NO_EN_PASSANT else en_passant
+    b.half_move_clock = half_move_clock
+    b.full_move_number = full_move_number
+
+    b.reset_zobrist_key()
+    return b
+
+def validate_packed(packed):
+    if not isinstance(packed, str) or len(packed) != PACKED_SIZE:
+        raise Exception, "Not a packed position: {!r}".format(packed)
+
+## CONTAINERS
+# both keep the packed positions back to back in a bytearray, a few million positions
+# take PACKED_SIZE bytes each instead of a Python object per position
+
+# list of packed positions, only appending is supported
+class PositionArray(object):
+    def __init__(self, positions=()):
+        self.data = bytearray()
+        self.extend(positions)
+
+    @classmethod
+    def from_boards(cls, boards):
+        return cls(pack(b) for b in boards)
+
+    # reads a file written by write()
+    @classmethod
+    def read(cls, f):
+        positions = cls()
+        positions.data = bytearray(f.read())
+        if len(positions.data) % PACKED_SIZE:
+            raise Exception, "File size is not a multiple of {}".format(PACKED_SIZE)
+        return positions
+
+    def write(self, f):
+        f.write(self.data)
+
+    def __len__(self):
+        return len(self.data) // PACKED_SIZE
+
+    def __getitem__(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("Position index out of range")
+        return str(self.data[index*PACKED_SIZE:(index+1)*PACKED_SIZE])
+
+    def __iter__(self):
+        data = self.data
+        for offset in xrange(0, len(data), PACKED_SIZE):
+            yield str(data[offset:offset+PACKED_SIZE])
+
+    def append(self, packed):
+        validate_packed(packed)
+        self.data += packed
+
+    def extend(self, positions):
+        for packed in positions:
+            self.append(packed)
+
+    def board(self, index, backend=board.LIST_BACKEND, cache=None):
+        return unpack(self[index], backend, cache)
+
+# set of packed positions as an open addressing hash table with linear probing,
+# the table doubles whenever it gets two thirds full
+class PositionSet(object):
+    def __init__(self, positions=(), capacity=1024):
+        if capacity < 1 or capacity & (capacity - 1):
+            raise Exception, "Capacity {} is not a power of two".format(capacity)
+        self.allocate(capacity)
+        self.update(positions)
+
+    def allocate(self, capacity):
+        self.capacity = capacity
+        self.slots = bytearray(capacity * PACKED_SIZE)
+        self.used = bytearray(capacity)
+        self.size = 0
+
+    # index of the slot holding the position or of the empty slot where it would go
+    def find_slot(self, packed):
+        mask = self.capacity - 1
+        slots, used = self.slots, self.used
+        index = hash(packed) & mask
+        while used[index]:
+            offset = index * PACKED_SIZE
+            if slots[offset:offset+PACKED_SIZE] == packed:
+                return index, True
+            index = (index + 1) & mask
+        return index, False
+
+    def add(self, packed):
+        validate_packed(packed)
+        if 3 * (self.size + 1) > 2 * self.capacity:
+            self.grow()
+
+        index, found = self.find_slot(packed)
+        if found:
+            return False
+        offset = index * PACKED_SIZE
+        self.slots[offset:offset+PACKED_SIZE] = packed
+        self.used[index] = 1
+        self.size += 1
+        return True
+
+    def update(self, positions):
+        for packed in positions:
+            self.add(packed)
+
+    def grow(self):
+        positions = list(self)
+        self.allocate(self.capacity * 2)
+        self.update(positions)
+
+    def __contains__(self, packed):
+        return self.find_slot(packed)[1]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        slots = self.slots
+        for index, used in enumerate(self.used):
+            if used:
+                offset = index * PACKED_SIZE
+                yield str(slots[offset:offset+PACKED_SIZE])
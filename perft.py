@@ -0,0 +1,170 @@
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+import timeit
+
+import board
+import instrumentation
+
+# standard perft positions with their known node counts by depth
+# promotions in this game always make a queen so the counts are for queen promotions only
+POSITIONS = [
+    { 'name' : 'initial', 'fen' : board.STARTING_FEN,
+      'nodes' : (20, 400, 8902, 197281) },
+    { 'name' : 'kiwipete', 'fen' : 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+      'nodes' : (48, 2039, 97862, 4074224) },
+    { 'name' : 'en passant endgame', 'fen' : '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+      'nodes' : (14, 191, 2812, 43238) },
+    { 'name' : 'en passant into rank pin', 'fen' : '3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1',
+      'nodes' : (18, 92, 1670, 10138) },
+    { 'name' : 'en passant available', 'fen' : '8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1',
+      'nodes' : (15, 126, 1928, 13931) },
+    { 'name' : 'promotions', 'fen' : 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+      'nodes' : (6, 228, 8087) },
+    { 'name' : 'promotions both sides', 'fen' : 'n1n5/PPPk4/8/8/8/8/4Kppp/5N1N b - - 0 1',
+      'nodes' : (15, 210, 3253) },
+]
+
+# operations timed on a sample of positions, in microseconds per call
+OPERATIONS = ('make_move', 'is_check', 'legal_moves_left', 'game_over')
+
+def setup_board(position, backend, cache=None):
+    return board.Board.from_fen(position['fen'], backend=backend, cache=cache)
+
+# the positions reached after each legal move from the suite positions
+def sample_boards(backend, cache=None):
+    boards = []
+    for position in POSITIONS:
+        root = setup_board(position, backend, cache)
+        boards.append(root)
+        for move in root.generate_legal_moves():
+            b = setup_board(position, backend, cache)
+            b.push(move)
+            boards.append(b)
+    return boards
+
+def run_perft(backend, max_depth, cache=None):
+    results = []
+    for position in POSITIONS:
+        b = setup_board(position, backend, cache)
+        for depth, expected in enumerate(position['nodes'][:max_depth], 1):
+            start = timeit.default_timer()
+            nodes = b.perft(depth)
+            seconds = timeit.default_timer() - start
+            results.append( { 'position' : position['name'], 'depth' : depth,
+                              'nodes' : nodes, 'expected' : expected, 'ok' : nodes == expected,
+                              'seconds' : seconds, 'nodes_per_second' : nodes / seconds if seconds else 0.0 } )
+    return results
+
+def run_timings(backend, repeat, cache=None):
+    boards = sample_boards(backend, cache)
+    moves = [ (b, b.generate_legal_moves()) for b in boards ]
+
+    timings = {}
+
+    calls, start = 0, timeit.default_timer()
+    for i in range(repeat):
+        for b, legal_moves in moves:
+            for move in legal_moves:
+                b.make_move(*move)
+                b.pop()
+                calls += 1
+    timings['make_move'] = (timeit.default_timer() - start) * 1e6 / calls
+
+    for operation in OPERATIONS[1:]:
+        calls, start = 0, timeit.default_timer()
+        for i in range(repeat):
+            for b in boards:
+                getattr(b, operation)()
+                calls += 1
+        timings[operation] = (timeit.default_timer() - start) * 1e6 / calls
+
+    return timings
+
+# compares against an earlier results file, returns the list of slowdowns
+# beyond the tolerance as human readable strings
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for backend, current in results['backends'].items():
+        previous = baseline['backends'].get(backend)
+        if previous is None:
+            continue
+
+        for operation, value in current['timings'].items():
+            before = previous['timings'].get(operation)
+            if before and value > before * (1 + tolerance):
+                regressions.append("{} {}: {:.1f}us -> {:.1f}us".format(backend, operation, before, value))
+
+        before = dict( ((r['position'], r['depth']), r['nodes_per_second']) for r in previous['perft'] )
+        for r in current['perft']:
+            nps = before.get( (r['position'], r['depth']) )
+            if nps and r['nodes_per_second'] < nps / (1 + tolerance):
+                regressions.append("{} perft {} depth {}: {:.0f} -> {:.0f} nodes/sec".format(
+                    backend, r['position'], r['depth'], nps, r['nodes_per_second']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Perft correctness and move generation benchmarks")
+    parser.add_argument('--backend', choices=(board.LIST_BACKEND, board.BITBOARD_BACKEND, 'all'), default='all')
+    parser.add_argument('--depth', type=int, default=3, help="maximum perft depth per position")
+    parser.add_argument('--repeat', type=int, default=3, help="passes over the sample positions for timings")
+    parser.add_argument('--cache', type=int, help="run with a position cache of this many entries")
+    parser.add_argument('--instrument', action='store_true', help="count and time the board methods during perft")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to check for slowdowns")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed slowdown ratio against --compare")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    backends = (board.LIST_BACKEND, board.BITBOARD_BACKEND) if args.backend == 'all' else (args.backend,)
+    results = { 'python' : platform.python_version(), 'timestamp' : time.time(),
+                'depth' : args.depth, 'cache' : args.cache, 'backends' : {} }
+
+    failed = False
+    for backend in backends:
+        cache = board.PositionCache(args.cache) if args.cache else None
+
+        if args.instrument:
+            instrumentation.reset()
+            with instrumentation.enabled():
+                perft = run_perft(backend, args.depth, cache)
+        else:
+            perft = run_perft(backend, args.depth, cache)
+        for r in perft:
+            status = 'ok' if r['ok'] else 'MISMATCH expected {}'.format(r['expected'])
+            print("{:8} {:26} depth {} {:>9} nodes {:8.3f}s {:>9.0f} nodes/sec {}".format(
+                backend, r['position'], r['depth'], r['nodes'], r['seconds'], r['nodes_per_second'], status))
+            failed = failed or not r['ok']
+
+        timings = run_timings(backend, args.repeat, cache)
+        for operation in OPERATIONS:
+            print("{:8} {:26} {:10.1f} us/call".format(backend, operation, timings[operation]))
+
+        results['backends'][backend] = { 'perft' : perft, 'timings' : timings }
+        if args.instrument:
+            results['backends'][backend]['instrumentation'] = instrumentation.snapshot()
+            print(instrumentation.format_report())
+        if cache is not None:
+            results['backends'][backend]['cache'] = cache.stats()
+            print("{:8} {:26} {hits} hits {misses} misses {evictions} evictions".format(
+                backend, 'cache', **cache.stats()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        failed = failed or bool(regressions)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
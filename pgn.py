@@ -0,0 +1,206 @@
+import argparse
+import collections
+import logging
+import re
+import sys
+import timeit
+
+import board
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# a game as read from the file, offset is the byte offset of its first line
+# and moves is the list of SAN moves of the main line
+Game = collections.namedtuple('Game', 'offset headers moves result')
+
+# a replayed game, moves are the (start, end) moves played and board the final position,
+# error is None when every move could be played or the reason the replay stopped
+GameResult = collections.namedtuple('GameResult', 'offset headers moves board error')
+
+HEADER_RE = re.compile(r'\[\s*(\w+)\s+"(.*)"\s*\]')
+TOKEN_RE = re.compile(r'\{[^}]*\}?|;[^\n]*|\(|\)|\$\d+|[^\s(){};]+')
+MOVE_NUMBER_RE = re.compile(r'^\d+\.+')
+SAN_RE = re.compile(r'^([KQRBN])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([QRBNqrbn]))?[+#]*[!?]*$')
+CASTLING_RE = re.compile(r'^(O-O-O|O-O|0-0-0|0-0)[+#]*[!?]*$')
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+
+# main line SAN moves and result of a game's movetext, skipping comments,
+# variations, numeric annotations and move numbers
+def parse_movetext(movetext):
+    moves, result, depth = [], None, 0
+    for token in TOKEN_RE.findall(movetext):
+        if token[0] in '{;$':
+            continue
+        if token == '(':
+            depth += 1
+            continue
+        if token == ')':
+            depth = max(depth-1, 0)
+            continue
+        if depth:
+            continue
+        if token in RESULTS:
+            result = token
+            continue
+
+        token = MOVE_NUMBER_RE.sub('', token)
+        if token:
+            moves.append(token)
+    return moves, result
+
+# streams the games of a PGN file one at a time without reading the whole file,
+# a game ends at its termination marker or at the first tag pair that follows some movetext
+def read_games(f):
+    offset = 0
+    game_offset, headers, movetext = None, {}, []
+
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        line_offset = offset
+        offset += len(line)
+
+        stripped = line.strip()
+        if not stripped:
+            continue
+
+        if stripped.startswith('['):
+            if movetext:
+                moves, result = parse_movetext(''.join(movetext))
+                yield Game(game_offset, headers, moves, result)
+                game_offset, headers, movetext = None, {}, []
+
+            if game_offset is None:
+                game_offset = line_offset
+            match = HEADER_RE.match(stripped)
+            if match:
+                headers[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+            continue
+
+        if game_offset is None:
+            game_offset = line_offset
+        movetext.append(line)
+
+        # the game termination marker also ends games that have no tag pairs
+        if stripped.split()[-1] in RESULTS:
+            moves, result = parse_movetext(''.join(movetext))
+            yield Game(game_offset, headers, moves, result)
+            game_offset, headers, movetext = None, {}, []
+
+    if headers or movetext:
+        moves, result = parse_movetext(''.join(movetext))
+        yield Game(game_offset, headers, moves, result)
+
+# squares holding a piece of the given name for the active color,
+# optionally narrowed down to a file and/or rank
+def candidate_squares(b, name, x=None, y=None):
+    for (i, j), piece in sorted(b.piece_squares[b.active_color].items()):
+        if piece.name == name and (x is None or i == x) and (y is None or j == y):
+            yield (i, j)
+
+# resolves a SAN move (Nf3, exd5, O-O, e8=Q, ...) to the legal (start, end) move it stands for
+def parse_san(b, san):
+    match = CASTLING_RE.match(san)
+    if match:
+        king = b.find_king(b.active_color)
+        if king is None:
+            raise Exception, "No king to castle with"
+        end = (king[0] + (-2 if len(match.group(1)) == 5 else 2), king[1])
+        if not (0 <= end[0] < 8) or not b.is_legal_move(king, end):
+            raise Exception, "Illegal castling {}".format(san)
+        return (king, end)
+
+    match = SAN_RE.match(san)
+    if not match:
+        raise Exception, "Cannot parse move {}".format(san)
+    piece, from_file, from_rank, target, promotion = match.groups()
+
+    if promotion is not None and promotion.lower() != board.QUEEN:
+        raise Exception, "Only promotion to a queen is supported, got {}".format(san)
+
+    name = piece.lower() if piece else board.PAWN
+    end = (ord(target[0]) - ord('a'), ord(target[1]) - ord('1'))
+    x = None if from_file is None else ord(from_file) - ord('a')
+    y = None if from_rank is None else ord(from_rank) - ord('1')
+
+    moves = [ (start, end) for start in candidate_squares(b, name, x, y) if b.is_legal_move(start, end) ]
+    if not moves:
+        raise Exception, "Illegal move {}".format(san)
+    if len(moves) > 1:
+        raise Exception, "Ambiguous move {}".format(san)
+    return moves[0]
+
+# plays the moves of a game from its starting position (standard or from the FEN tag)
+# until the end or the first move that cannot be played, visit is called with the
+# ply and the board for the starting position and after every move played
+def replay_game(game, backend=board.LIST_BACKEND, cache=None, log_positions=True, visit=None):
+    played, error = [], None
+    try:
+        b = board.Board(backend=backend, cache=cache, fen=game.headers.get('FEN'))
+    except Exception as e:
+        return GameResult(game.offset, game.headers, played, None, "Bad FEN tag: {}".format(e))
+
+    if visit is not None:
+        visit(0, b)
+    for ply, san in enumerate(game.moves):
+        try:
+            move = parse_san(b, san)
+        except Exception as e:
+            error = "Move {}{} {}: {}".format(b.full_move_number, '.' if b.active_color == board.WHITE else '...', san, e)
+            break
+
+        b.push(move)
+        played.append(move)
+        if visit is not None:
+            visit(ply+1, b)
+        if log_positions:
+            logger.debug("Current board position\n%s\n", b)
+
+    return GameResult(game.offset, game.headers, played, b, error)
+
+# the game starting at a byte offset of a PGN file, as found by read_games
+def read_game_at(f, offset):
+    f.seek(offset)
+    for game in read_games(f):
+        return game._replace(offset=offset)
+    raise Exception, "No game at offset {}".format(offset)
+
+# replays every game of a PGN file, in throughput mode the positions are not logged
+def replay_games(f, backend=board.LIST_BACKEND, cache=None, throughput=False):
+    for game in read_games(f):
+        yield replay_game(game, backend, cache, log_positions=not throughput)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay and validate the games of a PGN file")
+    parser.add_argument('path', help="PGN file to read")
+    parser.add_argument('--backend', choices=(board.LIST_BACKEND, board.BITBOARD_BACKEND), default=board.LIST_BACKEND)
+    parser.add_argument('--cache', type=int, help="use a position cache of this many entries")
+    parser.add_argument('--throughput', action='store_true',
+                        help="skip position logging and report games/sec and moves/sec")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.throughput else logging.DEBUG)
+
+    cache = board.PositionCache(args.cache) if args.cache else None
+
+    games, moves, errors = 0, 0, 0
+    start = timeit.default_timer()
+    with open(args.path, 'rb') as f:
+        for result in replay_games(f, args.backend, cache, args.throughput):
+            games += 1
+            moves += len(result.moves)
+            if result.error is not None:
+                errors += 1
+                logger.warning("Game %d at offset %d: %s", games, result.offset, result.error)
+    seconds = timeit.default_timer() - start
+
+    print("{} games, {} moves, {} errors in {:.2f}s".format(games, moves, errors, seconds))
+    if args.throughput and seconds:
+        print("{:.1f} games/sec, {:.0f} moves/sec".format(games / seconds, moves / seconds))
+
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+import argparse
+import asynchat
+import asyncore
+import collections
+import logging
+import multiprocessing.pool
+import os
+import Queue
+import re
+import socket
+import sys
+
+import board
+import engine
+import pgn
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+DEFAULT_PORT = 7777
+
+# threads the moves are validated and played on
+DEFAULT_WORKERS = 4
+
+COORDINATE_RE = re.compile(r'^([a-h][1-8])([a-h][1-8])[qQ]?$')
+
+## PROTOCOL
+# one command per line, words separated by spaces:
+#   new [fen]         starts a game and watches it, answered by "game <id>"
+#   watch <id>        receives the updates of a game
+#   show <id>         the position of a game, once
+#   move <id> <move>  plays a move in coordinate (e2e4) or SAN (e4, Nf3, O-O) notation
+#   close <id>        stops watching a game
+#   quit              closes the connection
+# the server pushes to the watchers of a game
+#   position <id> <move or -> <fen>
+#   over <id> <reason>
+# and answers a command it cannot carry out with "error <id or -> <reason>"
+# a game is dropped, finished or not, once nobody watches it any more
+
+def parse_square(name):
+    return (ord(name[0]) - ord('a'), ord(name[1]) - ord('1'))
+
+def parse_move(b, text):
+    match = COORDINATE_RE.match(text)
+    if match:
+        move = (parse_square(text[0:2]), parse_square(text[2:4]))
+        if not b.is_legal_move(*move):
+            raise Exception, "Illegal move {}".format(text)
+        return move
+    return pgn.parse_san(b, text)
+
+# runs on an executor thread, a game only ever has one job running so its board is
+# never used by two threads at once, exceptions are returned since the pool drops them
+def play_move(b, text):
+    try:
+        move = parse_move(b, text)
+        b.push(move)
+        return None, move, b.to_fen(), b.game_over()
+    except Exception as e:
+        return str(e), None, None, None
+
+class Game(object):
+    def __init__(self, game_id, b):
+        self.id = game_id
+        self.board = b
+        # what the event loop knows of the board, updated when a move has been played
+        self.fen = b.to_fen()
+        self.status = b.game_over()
+        self.watchers = set()
+        # (connection, move text) waiting for the move being played
+        self.pending = collections.deque()
+        self.busy = False
+
+class Connection(asynchat.async_chat):
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.server = server
+        self.received = []
+        self.set_terminator('\n')
+
+    def collect_incoming_data(self, data):
+        self.received.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.received).strip()
+        self.received = []
+        if line:
+            self.server.handle_line(self, line)
+
+    def send_line(self, line):
+        if self.connected:
+            self.push(line + '\n')
+
+    def handle_close(self):
+        self.server.disconnect(self)
+        self.close()
+
+# the executor threads write to a pipe to wake the event loop up when they have results
+class Wakeup(asyncore.file_dispatcher):
+    def __init__(self, server):
+        read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map=server.map)
+        os.close(read_fd)
+        self.server = server
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.server.process_results()
+
+    def wake(self):
+        os.write(self.write_fd, 'x')
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+
+# hosts any number of games for line based TCP clients, the event loop only reads and
+# writes lines while parsing, playing and checking moves happens on the executor threads
+class GameServer(asyncore.dispatcher):
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, workers=DEFAULT_WORKERS, backend=board.LIST_BACKEND):
+        board.validate_backend(backend)
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind( (host, port) )
+        self.listen(128)
+        self.address = self.socket.getsockname()
+
+        self.backend = backend
+        self.games = {}
+        self.next_id = 1
+        self.executor = multiprocessing.pool.ThreadPool(workers)
+        self.results = Queue.Queue()
+        self.wakeup = Wakeup(self)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Connection(pair[0], self)
+
+    def serve_forever(self):
+        logger.info("Serving games on %s:%d", *self.address)
+        asyncore.loop(timeout=1.0, use_poll=True, map=self.map)
+
+    # closes the listening socket and the connections, serve_forever returns once they are gone
+    def shutdown(self):
+        for dispatcher in self.map.values():
+            dispatcher.close()
+        self.executor.terminate()
+
+    def disconnect(self, connection):
+        for game in self.games.values():
+            game.watchers.discard(connection)
+            self.release(game)
+
+    # drops a game nobody watches, once the move being played (if any) is done
+    def release(self, game):
+        if not game.watchers and not game.busy and self.games.get(game.id) is game:
+            del self.games[game.id]
+            logger.debug("Game %s dropped, %d games left", game.id, len(self.games))
+
+    def handle_line(self, connection, line):
+        words = line.split()
+        command = getattr(self, 'command_' + words[0].lower(), None)
+        if command is None:
+            connection.send_line("error - Unknown command {}".format(words[0]))
+            return
+        try:
+            command(connection, words[1:])
+        except Exception as e:
+            connection.send_line("error {} {}".format(words[1] if len(words) > 1 else '-', e))
+
+    def find_game(self, args, count=1):
+        if len(args) < count:
+            raise Exception, "Missing arguments"
+        game = self.games.get(args[0])
+        if game is None:
+            raise Exception, "No game {}".format(args[0])
+        return game
+
+    def send_position(self, connections, game, move=None):
+        line = "position {} {} {}".format(game.id, '-' if move is None else engine.format_move(move), game.fen)
+        for connection in connections:
+            connection.send_line(line)
+        if game.status is not None:
+            for connection in connections:
+                connection.send_line("over {} {}".format(game.id, game.status))
+
+    ## COMMANDS
+
+    def command_new(self, connection, args):
+        try:
+            b = board.Board(backend=self.backend, fen=' '.join(args) if args else None)
+        except Exception as e:
+            connection.send_line("error - {}".format(e))
+            return
+
+        game = Game(str(self.next_id), b)
+        self.next_id += 1
+        self.games[game.id] = game
+        game.watchers.add(connection)
+        connection.send_line("game {}".format(game.id))
+        self.send_position( (connection,), game )
+
+    def command_watch(self, connection, args):
+        game = self.find_game(args)
+        game.watchers.add(connection)
+        self.send_position( (connection,), game )
+
+    def command_show(self, connection, args):
+        self.send_position( (connection,), self.find_game(args) )
+
+    def command_move(self, connection, args):
+        game = self.find_game(args, 2)
+        if game.status is not None:
+            raise Exception, "Game is over: {}".format(game.status)
+        game.pending.append( (connection, args[1]) )
+        self.start_next(game)
+
+    def command_close(self, connection, args):
+        game = self.find_game(args)
+        game.watchers.discard(connection)
+        self.release(game)
+
+    def command_quit(self, connection, args):
+        connection.close_when_done()
+
+    ## EXECUTOR
+
+    def start_next(self, game):
+        if game.busy or not game.pending:
+            return
+        connection, text = game.pending.popleft()
+        game.busy = True
+
+        def done(result):
+            self.results.put( (game, connection, result) )
+            self.wakeup.wake()
+        self.executor.apply_async(play_move, (game.board, text), callback=done)
+
+    # called on the event loop with the moves the executor has finished
+    def process_results(self):
+        while True:
+            try:
+                game, connection, (error, move, fen, status) = self.results.get_nowait()
+            except Queue.Empty:
+                return
+
+            game.busy = False
+            if error is not None:
+                connection.send_line("error {} {}".format(game.id, error))
+            else:
+                game.fen, game.status = fen, status
+                self.send_position(game.watchers, game, move)
+
+            if game.status is not None:
+                for waiting, text in game.pending:
+                    waiting.send_line("error {} Game is over: {}".format(game.id, game.status))
+                game.pending.clear()
+            self.start_next(game)
+            self.release(game)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Host many games for line based TCP clients")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="threads playing the moves")
+    parser.add_argument('--backend', choices=(board.LIST_BACKEND, board.BITBOARD_BACKEND), default=board.LIST_BACKEND)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    server = GameServer(args.host, args.port, args.workers, args.backend)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,94 @@
 import Tkinter as tk
 import board
+import engine
 import logging
+import multiprocessing
 import os
+import Queue
 
-logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 DARK_SQUARE_COLOR = '#58ae8b'
 LIGHT_SQUARE_COLOR = '#feffed'
+HIGHLIGHT_COLOR = '#f6d743'
 
 SQUARE_SIZE = 64
 
+# how often (in ms) the UI looks for analysis results
+POLL_INTERVAL = 30
+
+# seconds the computer thinks about its moves
+THINK_TIME = 2.0
+
 MYDIR = os.path.dirname(os.path.realpath(__file__))
 
+# runs in the analysis process: works through the jobs, skipping the ones that have been
+# superseded by a newer job, and stops a search as soon as its job becomes stale
+def analysis_loop(jobs, results, latest_job):
+    logging.getLogger().setLevel(logging.WARNING)
+    searcher = engine.Engine()
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        job_id, fen, moves, think_time = job
+        if job_id != latest_job.value:
+            continue
+
+        # replaying the moves keeps the history needed for repetitions
+        b = board.Board.from_fen(fen)
+        for move in moves:
+            b.push(move)
+
+        status = b.game_over()
+        move = None
+        if status is None and think_time:
+            stale = lambda: latest_job.value != job_id
+            move = searcher.search(b, time_limit=think_time, stop=stale).move
+
+        if job_id == latest_job.value:
+            results.put( (job_id, status, move) )
+
+# game-over detection and engine replies run in a separate process so the Tk event
+# loop never waits on them, submitting a job cancels all the earlier ones
+class AnalysisWorker(object):
+    def __init__(self):
+        self.jobs = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.latest_job = multiprocessing.Value('i', 0)
+
+        self.process = multiprocessing.Process(target=analysis_loop,
+                                               args=(self.jobs, self.results, self.latest_job))
+        self.process.daemon = True
+        self.process.start()
+
+    # queues the analysis of the board's position and returns the job id,
+    # the engine is asked for a move when think_time is given
+    def submit(self, chess_board, think_time=None):
+        self.latest_job.value += 1
+        moves = [record[0] for record in chess_board.undo_stack]
+        self.jobs.put( (self.latest_job.value, board.STARTING_FEN, moves, think_time) )
+        return self.latest_job.value
+
+    def cancel(self):
+        self.latest_job.value += 1
+
+    # (job_id, status, move) results received so far, never blocks
+    def poll(self):
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except Queue.Empty:
+                return results
+
+    def close(self):
+        self.cancel()
+        self.jobs.put(None)
+        self.process.join(1)
+
 class Chess(tk.Frame):
     def __init__(self, master=None):
         tk.Frame.__init__(self, master)
@@ -46,45 +123,125 @@ class Chess(tk.Frame):
                     outline=color, fill=color, tag=tags)
         
         self.canvas.grid(row=0, column=0)
+
+        # (x, y) square to the (canvas item, piece symbol) drawn on it
+        self.square_items = {}
         self.refresh_canvas()
 
+        # add bindings for clicking, dragging and releasing over
+        # any object with the "piece" tag
+        self.canvas.tag_bind("piece", "<ButtonPress-1>", self.piece_press)
+        self.canvas.tag_bind("piece", "<ButtonRelease-1>", self.piece_release)
+        self.canvas.tag_bind("piece", "<B1-Motion>", self.piece_motion)
+
         self.quitButton = tk.Button(self, text='Quit', command=self.quit)
         self.quitButton.grid(columnspan=2)
 
         self.newButton = tk.Button(self, text='New Game', command=self.reset_board)
         self.newButton.grid(columnspan=2)
 
+        self.computer_black = tk.IntVar()
+        self.computerButton = tk.Checkbutton(self, text='Computer plays black', variable=self.computer_black,
+                                             command=self.analyze)
+        self.computerButton.grid(columnspan=2)
+
+        self.status = tk.Label(self, text='')
+        self.status.grid(columnspan=2)
+
+        self.worker = AnalysisWorker()
+        self.job_id = None
+        self.analyze()
+        self.after(POLL_INTERVAL, self.poll_analysis)
+
+    def quit(self):
+        self.worker.close()
+        tk.Frame.quit(self)
+
     def reset_board(self):
         self.chess_board = board.Board()
         self.refresh_canvas()
+        self.analyze()
+
+    def computer_to_move(self):
+        return self.computer_black.get() and self.chess_board.active_color == board.BLACK
+
+    # hands the current position to the worker, any analysis still running is cancelled
+    def analyze(self):
+        think_time = THINK_TIME if self.computer_to_move() else None
+        self.job_id = self.worker.submit(self.chess_board, think_time)
+        self.status.config(text='Thinking...' if think_time else '')
+
+    def poll_analysis(self):
+        for job_id, status, move in self.worker.poll():
+            if job_id != self.job_id:
+                continue  # result for an earlier position
+            self.job_id = None
+
+            if status is not None:
+                self.status.config(text=status)
+            elif move is not None and self.computer_to_move():
+                self.chess_board.make_move(*move)
+                self.redraw_last_move()
+                self.analyze()
+            else:
+                self.status.config(text='')
+
+        self.after(POLL_INTERVAL, self.poll_analysis)
+
+    # top left corner of the square on the canvas
+    def square_origin(self, x, y):
+        return x*SQUARE_SIZE, (7-y)*SQUARE_SIZE
+
+    # brings the canvas in line with the board on one square, an image already
+    # showing the right piece is only put back in place
+    def draw_square(self, x, y):
+        piece = self.chess_board.get_piece(x,y)
+        symbol = None if piece is None else str(piece)
 
-    def place_piece(self, square, piece):
-        # canvas rectangle objects are tagged with 'a1', etc.
-        item = self.canvas.find_withtag(square)
-        # get bounding box of rectangle (we'll draw piece here)
-        coords = self.canvas.coords(item)
-        # do it
-        photo = self.piece2photo[str(piece)]
-        image = self.canvas.create_image(coords[0], coords[1], image=photo,
-                                         state=tk.NORMAL, anchor=tk.NW, tag='piece')
+        item, drawn = self.square_items.get( (x,y), (None, None) )
+        if item is not None:
+            if drawn == symbol:
+                self.canvas.coords(item, *self.square_origin(x,y))
+                return
+            self.canvas.delete(item)
+            del self.square_items[(x,y)]
 
+        if symbol is not None:
+            left, top = self.square_origin(x,y)
+            item = self.canvas.create_image(left, top, image=self.piece2photo[symbol],
+                                            state=tk.NORMAL, anchor=tk.NW, tag='piece')
+            self.square_items[(x,y)] = (item, symbol)
+
+    # full redraw, only needed for a new board
     def refresh_canvas(self):
         self.canvas.delete('piece')
+        self.square_items = {}
 
-        for x, fname in enumerate(list('abcdefgh')):
-            for y, rname in enumerate(list('12345678')):
-                sname = fname + rname
+        for x in range(8):
+            for y in range(8):
+                self.draw_square(x,y)
 
-                piece = self.chess_board.get_piece(x,y)
-                if piece is not None:
-                    self.canvas.update_idletasks()
-                    self.place_piece(sname, piece)
+    # redraws the squares the last move changed, including the rook when castling,
+    # the pawn taken en passant and the promoted piece
+    def redraw_last_move(self):
+        for square in self.chess_board.last_move_squares():
+            self.draw_square(*square)
 
-        # add bindings for clicking, dragging and releasing over
-        # any object with the "piece" tag
-        self.canvas.tag_bind("piece", "<ButtonPress-1>", self.piece_press)
-        self.canvas.tag_bind("piece", "<ButtonRelease-1>", self.piece_release)
-        self.canvas.tag_bind("piece", "<B1-Motion>", self.piece_motion)
+    # marks the squares the piece on start can move to, the board works them out
+    # once per position so the release does not have to check the move again
+    def highlight_targets(self, start):
+        self.canvas.delete('highlight')
+        if self.computer_to_move():
+            return
+
+        radius = SQUARE_SIZE / 6
+        for x, y in self.chess_board.legal_moves_from(start):
+            left, top = self.square_origin(x,y)
+            centre_x, centre_y = left + SQUARE_SIZE/2, top + SQUARE_SIZE/2
+            self.canvas.create_oval(centre_x-radius, centre_y-radius, centre_x+radius, centre_y+radius,
+                                    fill=HIGHLIGHT_COLOR, outline=HIGHLIGHT_COLOR, tag='highlight')
+        # just above the squares so the pieces stay on top
+        self.canvas.tag_raise('highlight', 'square')
 
     def piece_press(self, event):
         '''Begining drag of an object'''
@@ -92,7 +249,8 @@ class Chess(tk.Frame):
         self._drag_data["item"] = self.canvas.find_closest(event.x, event.y)[0]
 
         self._drag_data["start"] =  (event.x / SQUARE_SIZE, 7 - event.y / SQUARE_SIZE)
-        logging.debug("Starting coords {}".format(board.c2n(*self._drag_data["start"])))
+        logger.debug("Starting coords %s", board.c2n(*self._drag_data["start"]))
+        self.highlight_targets(self._drag_data["start"])
 
         self._drag_data["x"] = event.x
         self._drag_data["y"] = event.y
@@ -101,10 +259,22 @@ class Chess(tk.Frame):
         '''End drag of an object'''
         # figure out where we are right now
         end = (event.x / SQUARE_SIZE, 7 - event.y / SQUARE_SIZE)
-        logging.debug("Ending coords {}".format(board.c2n(*end)))
+        logger.debug("Ending coords %s", board.c2n(*end))
 
-        self.chess_board.make_move(self._drag_data["start"], end)
-        self.refresh_canvas()
+        self.canvas.delete('highlight')
+
+        # the computer's pieces are not for the user to move
+        moved = False
+        if not self.computer_to_move() and end in self.chess_board.legal_moves_from(self._drag_data["start"]):
+            self.chess_board.make_move(self._drag_data["start"], end)
+            moved = True
+
+        if moved:
+            self.redraw_last_move()
+            self.analyze()
+        else:
+            # put the dragged piece back on its square
+            self.draw_square(*self._drag_data["start"])
 
         # reset the drag information
         self._drag_data["item"] = None